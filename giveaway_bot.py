@@ -4,7 +4,21 @@ import json
 import random
 import datetime
 import re
+import logging
+import logging.handlers
+import queue
+import functools
+import signal
 import asyncio
+import collections
+import heapq
+import bisect
+import secrets
+from array import array
+import tempfile
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, constants
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes
 import telegram.error
@@ -12,19 +26,291 @@ import telegram.error
 # --- Configuration ---
 # !!! METTEZ VOTRE PROPRE ID TELEGRAM ICI !!!
 ADMIN_USER_IDS = [6938893387] 
+# Tickets supplémentaires par rôle lors des tirages (ex : {"vip": 3}) ; sans rôle pondéré, 1 ticket
+ROLE_WEIGHTS: dict[str, int] = {}
 
 TOKEN = os.environ.get('TOKEN')
-active_giveaways = {}
 
-# --- Fichiers de stockage ---
-ROLES_FILE = "roles.json"
-HISTORY_FILE = "giveaway_history.json"
+# --- Fichiers de stockage (ouverts au lancement par open_stores ; surchargeables par variables d'environnement) ---
+ROLES_FILE = os.environ.get('ROLES_FILE', "roles.json")
+HISTORY_FILE = os.environ.get('HISTORY_FILE', "giveaway_history.json")
+GIVEAWAYS_DB = os.environ.get('GIVEAWAYS_DB', "giveaways.db")
+# Durée de conservation de l'historique des giveaways, en jours (0 = illimitée)
+# Attention : /reroll et /verifier_tirage ne fonctionnent plus sur les giveaways purgés
+HISTORY_RETENTION_DAYS = 0
+# Délai (en secondes) de regroupement des écritures de roles.json
+ROLES_FLUSH_DELAY = 2.0
+# Taille maximale d'un lot d'inscriptions appliqué en une fois
+PARTICIPATION_BATCH_SIZE = 500
+# Cadence de rafraîchissement du compte à rebours : (temps restant minimal en s, intervalle en s),
+# du plus lent au plus rapide ; le ticker partagé se réveille toutes les COUNTDOWN_TICK secondes
+COUNTDOWN_INTERVALS = [(600, 60), (60, 10), (0, 3)]
+COUNTDOWN_TICK = 1.0
+# Budget d'éditions de messages : intervalle minimal (s) entre deux éditions dans un même chat,
+# et nombre maximal d'éditions par seconde tous chats confondus
+EDIT_CHAT_MIN_INTERVAL = 3.0
+EDIT_GLOBAL_RATE = 25.0
+# Anti-spam du bouton « Participer » : durée (s) pendant laquelle une participation est mémorisée,
+# et nombre maximal de couples (utilisateur, giveaway) gardés en mémoire
+CLICK_DEDUP_TTL = 600.0
+CLICK_DEDUP_MAX_ENTRIES = 200_000
+# Seau à jetons par utilisateur : rafale maximale de clics, puis clics par seconde
+CLICK_BURST = 5
+CLICK_RATE = 1.0
+CLICK_RATE_MAX_USERS = 100_000
+
+# --- Mode de réception des mises à jour ---
+# "polling" (par défaut) ou "webhook" (serveur HTTP local, éventuellement derrière un load balancer)
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('PORT', os.environ.get('WEBHOOK_PORT', '8443')))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'webhook')
+# URL publique déclarée à Telegram via setWebhook ; vide = aucun enregistrement (tests locaux)
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Nombre de mises à jour traitées en parallèle, et taille maximale de la file d'attente
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', '64'))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', '10000'))
+
+# --- Exécution sur plusieurs workers ---
+# "local" (par défaut, un seul worker) ou "sqlite" (plusieurs workers partageant GIVEAWAYS_DB)
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'local')
+WORKER_ID = os.environ.get('WORKER_ID', f"{os.uname().nodename}:{os.getpid()}")
+# Durée (s) des baux de tirage et de compte à rebours, et cadence (s) de synchronisation entre workers
+LEASE_TTL = 90.0
+SHARED_SYNC_INTERVAL = 2.0
+
+# --- Journalisation & métriques ---
+# Niveau de journalisation (DEBUG active le traçage détaillé des clics, désactivé par défaut)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Port local d'exposition des métriques au format texte Prometheus (0 = désactivé)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+# Fichier d'instantané périodique des métriques en JSON (vide = désactivé) et intervalle en secondes
+METRICS_SNAPSHOT_FILE = os.environ.get('METRICS_SNAPSHOT_FILE', '')
+METRICS_SNAPSHOT_INTERVAL = 60
+
+logger = logging.getLogger("giveaway_bot")
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Journalisation non bloquante : les handlers ne font qu'empiler, un thread écrit sur la sortie."""
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    # La bibliothèque HTTP journalise chaque requête en INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    return listener
+
+class Metrics:
+    """Compteurs et histogrammes de latence en mémoire, exportables au format texte Prometheus."""
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self.counters: dict[tuple, int] = collections.Counter()
+        self.histograms: dict[tuple, list] = {}
+
+    def inc(self, name: str, amount: int = 1, **labels):
+        self.counters[(name, tuple(labels.items()))] += amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None: histogram = self.histograms[key] = [[0] * (len(self.LATENCY_BUCKETS) + 1), 0.0]
+        histogram[0][bisect.bisect_left(self.LATENCY_BUCKETS, value)] += 1
+        histogram[1] += value
+
+    def counter(self, name: str, **labels) -> int:
+        return self.counters.get((name, tuple(labels.items())), 0)
+
+    def quantile(self, name: str, q: float, **labels) -> float | None:
+        """Estimation d'un quantile (borne haute du bucket) à partir de l'histogramme."""
+        histogram = self.histograms.get((name, tuple(labels.items())))
+        if histogram is None: return None
+        target, seen = q * sum(histogram[0]), 0
+        for bound, count in zip(self.LATENCY_BUCKETS + (float('inf'),), histogram[0]):
+            seen += count
+            if seen >= target: return bound
+        return float('inf')
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels] + ([extra] if extra else [])
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, total) in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.LATENCY_BUCKETS + (float('inf'),), buckets):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f"{name}_bucket{self._labels(labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        return {
+            "counters": {f"{name}{self._labels(labels)}": value for (name, labels), value in self.counters.items()},
+            "latency_seconds": {f"{name}{self._labels(labels)}": {"count": sum(buckets), "sum": total, "p50": self.quantile(name, 0.5, **dict(labels)), "p99": self.quantile(name, 0.99, **dict(labels))}
+                                for (name, labels), (buckets, total) in self.histograms.items()},
+        }
+
+metrics = Metrics()
+
+def instrumented(handler):
+    """Mesure la latence d'un handler ou d'un job et compte ses erreurs, par nom de fonction."""
+    name = handler.__name__
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try: return await handler(*args, **kwargs)
+        except Exception:
+            metrics.inc("handler_errors_total", handler=name)
+            raise
+        finally: metrics.observe("handler_latency_seconds", time.perf_counter() - started, handler=name)
+    return wrapper
+
+def count_telegram_error(error: Exception):
+    metrics.inc("telegram_errors_total", type=type(error).__name__)
+
+async def serve_metrics(port: int):
+    """Expose /metrics au format texte Prometheus sur 127.0.0.1 (HTTP minimal, sans dépendance)."""
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass
+            if request_line.split(b" ")[1:2] == [b"/metrics"]:
+                body, status = metrics.render_prometheus().encode(), b"200 OK"
+            else: body, status = b"not found\n", b"404 Not Found"
+            writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        finally: writer.close()
+    return await asyncio.start_server(handle, "127.0.0.1", port)
+
+# --- Participants ---
+class ParticipantSet:
+    """Ensemble compact des identifiants (entiers) des participants d'un giveaway.
+
+    Les identifiants sont rangés dans un array('q') par ordre d'inscription, et une table de hachage
+    à adressage ouvert (array('I') d'indices + 1, 0 = libre) donne l'appartenance en O(1). Les
+    identifiants sont mélangés par hachage de Fibonacci (multiplication par une constante impaire de
+    64 bits, bits de poids fort) avant le sondage linéaire : des identifiants qui ne diffèrent que par
+    leurs bits de poids fort ne s'entassent pas dans les mêmes cases. Cela
+    revient à environ 16 à 24 octets par participant ; les noms ne sont pas gardés en mémoire mais
+    dans la table user_names, et ne sont relus que pour annoncer les gagnants.
+    """
+    __slots__ = ("ids", "_slots", "_mask", "_shift")
+    _MULTIPLIER, _MASK64 = 0x9E3779B97F4A7C15, 2**64 - 1
+
+    def __init__(self, user_ids=()):
+        self.ids = array('q')
+        self._slots = array('I', bytes(4 * 8))
+        self._mask, self._shift = 7, 64 - 3
+        for user_id in user_ids: self.add(user_id)
+
+    def _find(self, user_id: int) -> int:
+        """Position de `user_id` dans la table, ou de la case libre où l'insérer."""
+        slots, ids, mask = self._slots, self.ids, self._mask
+        i = ((user_id * self._MULTIPLIER) & self._MASK64) >> self._shift
+        while True:
+            slot = slots[i]
+            if slot == 0 or ids[slot - 1] == user_id: return i
+            i = (i + 1) & mask
+
+    def __contains__(self, user_id: int) -> bool:
+        return self._slots[self._find(user_id)] != 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def add(self, user_id: int) -> bool:
+        """Ajoute un participant ; retourne False s'il était déjà inscrit."""
+        i = self._find(user_id)
+        if self._slots[i]: return False
+        self.ids.append(user_id)
+        self._slots[i] = len(self.ids)
+        if 2 * len(self.ids) > len(self._slots): self._resize(2 * len(self._slots))
+        return True
+
+    def _resize(self, size: int):
+        self._slots, self._mask, self._shift = array('I', bytes(4 * size)), size - 1, 64 - (size.bit_length() - 1)
+        slots, mask, shift, multiplier, mask64 = self._slots, self._mask, self._shift, self._MULTIPLIER, self._MASK64
+        for index, user_id in enumerate(self.ids, 1):
+            i = ((user_id * multiplier) & mask64) >> shift
+            while slots[i]: i = (i + 1) & mask
+            slots[i] = index
+
+# --- Registre des giveaways actifs ---
+class GiveawayRegistry:
+    """Giveaways actifs indexés par identifiant unique, avec un index secondaire par chat/sujet.
+
+    Plusieurs giveaways peuvent coexister dans un même sujet. L'index par sujet est trié par
+    heure de fin (insertion par bisect), ce qui permet de les lister dans l'ordre sans tri.
+    """
+    def __init__(self):
+        self._by_id: dict[str, dict] = {}
+        self._by_topic: dict[tuple[int, int | None], list[tuple[datetime.datetime, str]]] = {}
+
+    @staticmethod
+    def _topic(giveaway: dict) -> tuple[int, int | None]:
+        return giveaway['chat_id'], giveaway['message_thread_id']
+
+    def new_id(self) -> str:
+        """Identifiant court et unique, compatible avec la limite de 64 octets des callback_data."""
+        while True:
+            giveaway_id = secrets.token_urlsafe(6)
+            if giveaway_id not in self._by_id: return giveaway_id
+
+    def __setitem__(self, giveaway_id: str, giveaway: dict):
+        if giveaway_id in self._by_id: del self[giveaway_id]
+        self._by_id[giveaway_id] = giveaway
+        bisect.insort(self._by_topic.setdefault(self._topic(giveaway), []), (giveaway['end_time'], giveaway_id))
+
+    def __delitem__(self, giveaway_id: str):
+        giveaway = self._by_id.pop(giveaway_id)
+        topic = self._topic(giveaway)
+        entries = self._by_topic[topic]
+        entries.pop(bisect.bisect_left(entries, (giveaway['end_time'], giveaway_id)))
+        if not entries: del self._by_topic[topic]
+
+    def __getitem__(self, giveaway_id: str) -> dict: return self._by_id[giveaway_id]
+    def __contains__(self, giveaway_id: str) -> bool: return giveaway_id in self._by_id
+    def __iter__(self): return iter(self._by_id)
+    def __len__(self) -> int: return len(self._by_id)
+    def get(self, giveaway_id: str, default=None): return self._by_id.get(giveaway_id, default)
+    def values(self): return self._by_id.values()
+    def items(self): return self._by_id.items()
+
+    def update(self, giveaways: dict):
+        for giveaway_id, giveaway in giveaways.items(): self[giveaway_id] = giveaway
+
+    def clear(self):
+        self._by_id.clear()
+        self._by_topic.clear()
+
+    def in_topic(self, chat_id: int, message_thread_id: int | None) -> list[str]:
+        """Identifiants des giveaways actifs d'un chat/sujet, du plus proche de la fin au plus lointain."""
+        return [giveaway_id for _, giveaway_id in self._by_topic.get((chat_id, message_thread_id), ())]
+
+active_giveaways = GiveawayRegistry()
 
 # --- Fonctions Utilitaires ---
+_MARKDOWN_V2_SPECIAL_CHARS = re.compile(f"([{re.escape(r'_*[]()~`>#+-=|{}.!')}])")
+
 def escape_markdown_v2(text: str) -> str:
     """Échappe les caractères spéciaux pour le format MarkdownV2 de Telegram."""
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
+    return _MARKDOWN_V2_SPECIAL_CHARS.sub(r'\\\1', text)
 
 def parse_duration(duration_str: str) -> datetime.timedelta | None:
     """Analyse une chaîne de durée (ex: '10h', '30m', '2d') et retourne un timedelta."""
@@ -36,89 +322,1070 @@ def parse_duration(duration_str: str) -> datetime.timedelta | None:
     elif unit == 'd': return datetime.timedelta(days=value)
     return None
 
+def format_time_left(end_time: datetime.datetime) -> str:
+    """Temps restant tel qu'affiché ; c'est la seule partie du message qui dépend de l'heure."""
+    seconds = int((end_time - datetime.datetime.now(end_time.tzinfo)).total_seconds())
+    if seconds <= 0: return "terminé \\!"
+    days, remainder = divmod(seconds, 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if days > 0: return f"dans {days}j {hours}h"
+    elif hours > 0: return f"dans {hours}h {minutes}m"
+    elif minutes > 0: return f"dans {minutes}m {seconds}s"
+    return f"dans {seconds}s"
+
+def build_message_template(giveaway: dict) -> tuple[str, str, str]:
+    """Parties fixes du message d'un giveaway, calculées une seule fois (prix, date de fin, hôte...)."""
+    end_time_str = giveaway['end_time'].strftime("%d %b %Y à %H:%M")
+    head = f"🎉 *{giveaway['prize']}* 🎉\n\n*Se termine :* "
+    middle = f" \\(le {end_time_str}\\)\n*Organisé par :* {giveaway['host_mention']}\n*Participants :* "
+    tail = f"\n*Gagnants :* {giveaway['winners_count']}"
+    if giveaway.get("required_role"): tail += f"\n*Réservé au rôle :* `{giveaway['required_role']}`"
+    return head, middle, tail
+
+def giveaway_fingerprint(giveaway: dict) -> tuple[str, int]:
+    """Empreinte de ce qui change à l'écran : si elle est identique, le message rendu l'est aussi."""
+    return format_time_left(giveaway['end_time']), len(giveaway['participants'])
+
 def format_giveaway_message(giveaway_key: str) -> str:
-    """Met en forme le message du giveaway pour l'affichage."""
+    """Met en forme le message du giveaway pour l'affichage.
+
+    Seuls le temps restant et le nombre de participants sont substitués dans le modèle du giveaway,
+    et le dernier rendu est réutilisé tel quel tant que l'empreinte ne change pas.
+    """
     giveaway = active_giveaways.get(giveaway_key)
     if not giveaway: return "Aucun giveaway en cours."
-    prize, end_time, host = giveaway['prize'], giveaway['end_time'], giveaway['host_mention']
-    participants_count, winners_count = len(giveaway['participants']), giveaway['winners_count']
-    now = datetime.datetime.now(end_time.tzinfo)
-    time_left = end_time - now
-    if time_left.total_seconds() <= 0: time_left_str = "terminé !"
-    else:
-        days, remainder = divmod(int(time_left.total_seconds()), 86400)
-        hours, remainder = divmod(remainder, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        if days > 0: time_left_str = f"dans {days}j {hours}h"
-        elif hours > 0: time_left_str = f"dans {hours}h {minutes}m"
-        elif minutes > 0: time_left_str = f"dans {minutes}m {seconds}s"
-        else: time_left_str = f"dans {seconds}s"
-    end_time_str = end_time.strftime("%d %b %Y à %H:%M")
-    message = ( f"🎉 *{prize}* 🎉\n\n" f"*Se termine :* {time_left_str} \\(le {end_time_str}\\)\n" f"*Organisé par :* {host}\n" f"*Participants :* {participants_count}\n" f"*Gagnants :* {winners_count}" )
-    if giveaway.get("required_role"): message += f"\n*Réservé au rôle :* `{giveaway['required_role']}`"
+    fingerprint = giveaway_fingerprint(giveaway)
+    rendered = giveaway.get('rendered')
+    if rendered is not None and rendered[0] == fingerprint: return rendered[1]
+    if 'template' not in giveaway: giveaway['template'] = build_message_template(giveaway)
+    head, middle, tail = giveaway['template']
+    message = f"{head}{fingerprint[0]}{middle}{fingerprint[1]}{tail}"
+    giveaway['rendered'] = (fingerprint, message)
     return message
 
+def giveaway_keyboard(giveaway_key: str) -> InlineKeyboardMarkup:
+    """Clavier « Participer » du giveaway, créé une fois puis réutilisé à chaque édition."""
+    giveaway = active_giveaways[giveaway_key]
+    if 'reply_markup' not in giveaway:
+        giveaway['reply_markup'] = InlineKeyboardMarkup([[InlineKeyboardButton("🎉 Participer", callback_data=f'participate_{giveaway_key}')]])
+    return giveaway['reply_markup']
+
+# --- Accès disque hors de la boucle asyncio ---
+_io_executors: dict[str, ThreadPoolExecutor] = {}
+
+def io_executor(path: str) -> ThreadPoolExecutor:
+    """Retourne le thread d'E/S dédié à un fichier : toutes ses lectures/écritures y sont sérialisées."""
+    key = os.path.abspath(path)
+    if key not in _io_executors: _io_executors[key] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"io-{os.path.basename(path)}")
+    return _io_executors[key]
+
+def report_io_error(future):
+    """Callback des écritures lancées sans attente : signale les erreurs au lieu de les perdre."""
+    if not future.cancelled() and future.exception() is not None:
+        metrics.inc("storage_errors_total")
+        logger.error("Erreur d'écriture sur disque", exc_info=future.exception())
+
+class SQLiteStore:
+    """Base des stockages SQLite : connexion en WAL, utilisée uniquement depuis le thread d'E/S du fichier.
+
+    Les méthodes des sous-classes sont synchrones et s'appellent via `run`/`submit` depuis les handlers.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # Plusieurs workers peuvent partager le fichier (STATE_BACKEND=sqlite) : on attend le verrou au lieu d'échouer
+        self.conn.execute("PRAGMA busy_timeout=5000")
+
+    async def run(self, fn, *args):
+        """Exécute `fn(*args)` dans le thread d'E/S du fichier et attend son résultat."""
+        return await asyncio.get_running_loop().run_in_executor(io_executor(self.path), fn, *args)
+
+    def submit(self, fn, *args):
+        """Lance `fn(*args)` dans le thread d'E/S du fichier sans attendre (l'ordre des écritures est conservé)."""
+        future = io_executor(self.path).submit(fn, *args)
+        future.add_done_callback(report_io_error)
+        return future
+
 # --- Fonctions de Gestion des Rôles & Historique ---
-def load_roles():
-    """Charge les données des rôles depuis le fichier JSON."""
-    try:
-        with open(ROLES_FILE, 'r') as f:
-            content = f.read()
-            if not content: return {}
-            return json.loads(content)
-    except (FileNotFoundError, json.JSONDecodeError): return {}
-
-def save_roles(roles_data):
-    """Sauvegarde les données des rôles dans le fichier JSON."""
-    with open(ROLES_FILE, 'w') as f: json.dump(roles_data, f, indent=4)
-
-def load_history():
-    """Charge l'historique des giveaways depuis le fichier JSON."""
-    try:
-        with open(HISTORY_FILE, 'r') as f:
-            content = f.read()
-            if not content: return {}
-            return json.loads(content)
-    except (FileNotFoundError, json.JSONDecodeError): return {}
+class RoleStore:
+    """Index des rôles en mémoire, persisté en écriture différée (write-behind) dans roles.json.
 
-def save_history(history_data):
-    """Sauvegarde l'historique des giveaways dans le fichier JSON."""
-    with open(HISTORY_FILE, 'w') as f: json.dump(history_data, f, indent=4)
+    Le fichier n'est lu qu'une fois au démarrage : les vérifications de rôle se font ensuite
+    en O(1) sans aucun accès disque. Les modifications sont regroupées puis écrites de façon
+    atomique (fichier temporaire + renommage) après ROLES_FLUSH_DELAY secondes, depuis le
+    thread d'E/S du fichier.
+    """
+    def __init__(self, path: str, flush_delay: float):
+        self.path, self.flush_delay = path, flush_delay
+        self._members: dict[str, set[int]] = {}
+        self._user_roles: dict[int, set[str]] = {}
+        self._dirty, self._flush_handle = False, None
+        self._load()
 
-# --- Tâches planifiées (Jobs) ---
-async def update_countdown_job(context: ContextTypes.DEFAULT_TYPE):
-    giveaway_key = context.job.data['giveaway_key']
-    if giveaway_key not in active_giveaways:
-        context.job.schedule_removal()
-        return
+    def _load(self):
+        self._mtime, data = self._read()
+        self._apply(data)
+
+    def _read(self) -> tuple[int | None, dict]:
+        """Date de modification et contenu du fichier (bloquant : au démarrage ou dans le thread d'E/S)."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, 'r') as f:
+                content = f.read()
+                return mtime, json.loads(content) if content else {}
+        except FileNotFoundError: return None, {}
+        except json.JSONDecodeError: return mtime, {}
+
+    def _read_if_changed(self, known_mtime: int | None) -> tuple[int | None, dict] | None:
+        try: mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError: mtime = None
+        return None if mtime == known_mtime else self._read()
+
+    def _apply(self, data: dict):
+        self._members, self._user_roles = {}, {}
+        for role_name, member_ids in data.items():
+            for user_id in member_ids: self._index(role_name, user_id)
+            self._members.setdefault(role_name, set())
+
+    async def reload_if_changed(self) -> bool:
+        """Relit le fichier s'il a été réécrit par un autre worker (sauf modifications locales en attente).
+
+        Le stat et la lecture se font dans le thread d'E/S du fichier ; seuls les index sont remplacés sur la boucle.
+        """
+        if self._dirty or self._flush_handle is not None: return False
+        changed = await asyncio.get_running_loop().run_in_executor(io_executor(self.path), self._read_if_changed, self._mtime)
+        # Une modification locale a pu arriver pendant la lecture : elle l'emporte, le fichier sera réécrit
+        if changed is None or self._dirty or self._flush_handle is not None: return False
+        self._mtime, data = changed
+        self._apply(data)
+        return True
+
+    def _index(self, role_name: str, user_id: int):
+        self._members.setdefault(role_name, set()).add(user_id)
+        self._user_roles.setdefault(user_id, set()).add(role_name)
+
+    def role_exists(self, role_name: str) -> bool:
+        return role_name in self._members
+
+    def has_role(self, user_id: int, role_name: str) -> bool:
+        return role_name in self._user_roles.get(user_id, ())
+
+    def members(self, role_name: str) -> set[int]:
+        return self._members.get(role_name, set())
+
+    def roles_of(self, user_id: int) -> list[str]:
+        return sorted(self._user_roles.get(user_id, ()))
+
+    def as_dict(self) -> dict[str, list[int]]:
+        return {role_name: sorted(member_ids) for role_name, member_ids in self._members.items()}
+
+    def assign(self, role_name: str, user_id: int) -> bool:
+        """Assigne un rôle ; retourne False si l'utilisateur l'avait déjà."""
+        if self.has_role(user_id, role_name): return False
+        self._index(role_name, user_id)
+        self._schedule_flush()
+        return True
+
+    def remove(self, role_name: str, user_id: int) -> bool:
+        """Retire un rôle (et le supprime s'il n'a plus de membres) ; retourne False s'il n'était pas assigné."""
+        if not self.has_role(user_id, role_name): return False
+        self._members[role_name].discard(user_id)
+        if not self._members[role_name]: del self._members[role_name]
+        self._user_roles[user_id].discard(role_name)
+        if not self._user_roles[user_id]: del self._user_roles[user_id]
+        self._schedule_flush()
+        return True
+
+    def _schedule_flush(self):
+        self._dirty = True
+        try: loop = asyncio.get_running_loop()
+        except RuntimeError: return self.flush()
+        if self._flush_handle is None: self._flush_handle = loop.call_later(self.flush_delay, self._flush_in_background)
+
+    def _flush_in_background(self):
+        self._flush_handle = None
+        if not self._dirty: return
+        self._dirty = False
+        # L'instantané est pris sur la boucle ; seule l'écriture part dans le thread d'E/S
+        future = io_executor(self.path).submit(self._write, self.as_dict())
+        future.add_done_callback(self._on_write_done)
+
+    def _on_write_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self._dirty = True
+            report_io_error(future)
+
+    def flush(self):
+        """Écrit l'état courant sur disque (bloquant, pour l'arrêt), si des modifications sont en attente."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty: return
+        self._dirty = False
+        io_executor(self.path).submit(self._write, self.as_dict()).result()
+
+    def _write(self, snapshot: dict):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".roles-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+
+
+class UserNameStore(SQLiteStore):
+    """Table dédupliquée user_id -> nom affiché, partagée par tous les giveaways et l'historique."""
+    UPSERT = "INSERT INTO user_names VALUES (?, ?) ON CONFLICT (user_id) DO UPDATE SET full_name = excluded.full_name"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS user_names (user_id INTEGER PRIMARY KEY, full_name TEXT NOT NULL)")
+
+    def save(self, rows: list[tuple[int, str]]):
+        """Enregistre un lot de (user_id, full_name) ; le nom le plus récent l'emporte."""
+        if not rows: return
+        with self.conn: self.conn.executemany(self.UPSERT, rows)
+
+    def get(self, user_ids: list[int]) -> dict[int, str]:
+        names = {}
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            query = f"SELECT user_id, full_name FROM user_names WHERE user_id IN ({','.join('?' * len(chunk))})"
+            names.update(self.conn.execute(query, chunk))
+        return names
+
+
+class HistoryStore(SQLiteStore):
+    """Historique des giveaways terminés, indexé par message d'annonce des gagnants.
+
+    Un tirage ajoute une ligne, un reroll en met une à jour : le fichier n'est jamais
+    relu ni réécrit en entier. Les participants sont stockés sous forme d'identifiants binaires
+    (array('q')), leurs noms restant dans user_names. L'ancien giveaway_history.json est importé
+    une seule fois.
+    """
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS history (
+                chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, message_thread_id INTEGER,
+                prize TEXT NOT NULL, participant_ids BLOB NOT NULL, winner_ids TEXT NOT NULL, created_at REAL NOT NULL,
+                seed INTEGER, pool_ids BLOB, pool_prob BLOB, pool_alias BLOB, rerolls INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (chat_id, message_id))""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS history_created_at ON history (created_at)")
+
+    def append(self, message_id: int, entry: dict):
+        # Le pool n'est stocké que s'il diffère des participants (rôle requis) ; les tables d'alias
+        # du tirage pondéré sont gardées pour que les rerolls et vérifications n'aient rien à recalculer
+        pool, sampler = entry['pool_ids'], entry['sampler']
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry['chat_id'], message_id, entry['message_thread_id'], entry['prize'],
+                 entry['participant_ids'].tobytes(), json.dumps(entry['winner_ids']), time.time(), entry['seed'],
+                 None if pool is entry['participant_ids'] else pool.tobytes(),
+                 sampler.prob.tobytes() if sampler else None, sampler.alias.tobytes() if sampler else None, entry['rerolls']))
+
+    def get(self, chat_id: int, message_id: int) -> dict | None:
+        row = self.conn.execute(
+            "SELECT message_thread_id, prize, participant_ids, winner_ids, seed, pool_ids, pool_prob, pool_alias, rerolls"
+            " FROM history WHERE chat_id = ? AND message_id = ?",
+            (chat_id, message_id)).fetchone()
+        if row is None: return None
+        thread_id, prize, participant_ids, winner_ids, seed, pool_ids, pool_prob, pool_alias, rerolls = row
+        def unpack(typecode: str, blob: bytes) -> array:
+            values = array(typecode)
+            values.frombytes(blob)
+            return values
+        ids = unpack('q', participant_ids)
+        sampler = AliasSampler(unpack('d', pool_prob), unpack('q', pool_alias)) if pool_prob is not None else None
+        return { "prize": prize, "participant_ids": ids, "winner_ids": json.loads(winner_ids), "chat_id": chat_id, "message_thread_id": thread_id,
+                 "seed": seed, "pool_ids": unpack('q', pool_ids) if pool_ids is not None else ids, "sampler": sampler, "rerolls": rerolls }
+
+    def reroll(self, chat_id: int, message_id: int) -> tuple[dict, int | None] | None:
+        """Tire un gagnant supplémentaire et l'enregistre ; retourne (entrée, nouveau gagnant ou None).
+
+        Lecture, tirage et écriture se font d'un seul tenant dans le thread d'E/S : deux /reroll
+        simultanés ne peuvent pas lire le même compteur ni tirer le même gagnant.
+        """
+        entry = self.get(chat_id, message_id)
+        if entry is None: return None
+        # Chaque reroll a sa propre graine dérivée, pour rester rejouable
+        seed, reroll_number = entry['seed'], entry['rerolls'] + 1
+        rng = random.Random(f"{seed}:{reroll_number}") if seed is not None else random.Random()
+        new_winners = pick_winners(entry['pool_ids'], entry['sampler'], 1, rng, exclude=entry['winner_ids'])
+        if not new_winners: return entry, None
+        entry['winner_ids'].append(new_winners[0])
+        entry['rerolls'] = reroll_number
+        with self.conn:
+            self.conn.execute("UPDATE history SET winner_ids = ?, rerolls = ? WHERE chat_id = ? AND message_id = ?", (json.dumps(entry['winner_ids']), reroll_number, chat_id, message_id))
+        return entry, new_winners[0]
+
+    def compact(self, retention_days: int) -> int:
+        """Supprime les entrées plus anciennes que la durée de conservation et récupère la place libérée."""
+        if retention_days <= 0: return 0
+        with self.conn:
+            deleted = self.conn.execute("DELETE FROM history WHERE created_at < ?", (time.time() - retention_days * 86400,)).rowcount
+        if deleted: self.conn.execute("VACUUM")
+        return deleted
+
+    def migrate_from_json(self, path: str) -> int:
+        """Importe l'ancien fichier d'historique JSON, puis le renomme pour ne plus le relire."""
+        try:
+            with open(path, 'r') as f:
+                content = f.read()
+                legacy = json.loads(content) if content else {}
+        except FileNotFoundError: return 0
+        except json.JSONDecodeError: legacy = {}
+        imported_at = os.path.getmtime(path)
+        with self.conn:
+            for message_id, entry in legacy.items():
+                participants = entry['participants']
+                self.conn.executemany(UserNameStore.UPSERT, ((int(uid_str), name) for uid_str, name in participants.items()))
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO history VALUES (?, ?, ?, ?, ?, ?, ?, NULL, NULL, NULL, NULL, 0)",
+                    (entry['chat_id'], int(message_id), entry.get('message_thread_id'), entry['prize'],
+                     array('q', map(int, participants)).tobytes(), json.dumps(entry['winner_ids']), imported_at))
+        os.replace(path, path + ".migrated")
+        return len(legacy)
+
+
+# --- Persistance des giveaways actifs ---
+class GiveawayStore(SQLiteStore):
+    """Journal SQLite des giveaways actifs, pour survivre aux redémarrages du worker.
+
+    Chaque giveaway est écrit une fois à sa création, puis les participants (identifiants seuls,
+    les noms vont dans user_names) sont ajoutés par lots au fil des inscriptions, sans jamais
+    réécrire l'ensemble.
+    Le statut ('open', 'closed' pendant le tirage, 'cancelled' en attente de l'édition d'annulation)
+    ne sert qu'à coordonner plusieurs workers ; avec un seul worker, il reste 'open'.
+    """
+    COLUMNS = "giveaway_key, chat_id, message_thread_id, message_id, prize, required_role, end_time, host_mention, winners_count"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS giveaways (
+                giveaway_key TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, message_thread_id INTEGER,
+                message_id INTEGER, prize TEXT NOT NULL, required_role TEXT, end_time TEXT NOT NULL,
+                host_mention TEXT NOT NULL, winners_count INTEGER NOT NULL, status TEXT NOT NULL DEFAULT 'open');
+            CREATE TABLE IF NOT EXISTS participants (
+                giveaway_key TEXT NOT NULL, user_id INTEGER NOT NULL,
+                PRIMARY KEY (giveaway_key, user_id)) WITHOUT ROWID;
+        """)
+
+    def save_giveaway(self, giveaway_key: str, giveaway: dict):
+        with self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO giveaways ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (giveaway_key, giveaway['chat_id'], giveaway['message_thread_id'], giveaway['message_id'], giveaway['prize'],
+                 giveaway['required_role'], giveaway['end_time'].isoformat(), giveaway['host_mention'], giveaway['winners_count']))
+
+    def add_participants(self, rows: list[tuple[str, int]]):
+        """Ajoute un lot de (giveaway_key, user_id) en une seule transaction."""
+        if not rows: return
+        with self.conn: self.conn.executemany("INSERT OR IGNORE INTO participants VALUES (?, ?)", rows)
+
+    def delete_giveaway(self, giveaway_key: str):
+        with self.conn:
+            self.conn.execute("DELETE FROM participants WHERE giveaway_key = ?", (giveaway_key,))
+            self.conn.execute("DELETE FROM giveaways WHERE giveaway_key = ?", (giveaway_key,))
+
+    def set_status(self, giveaway_key: str, status: str, allowed: tuple[str, ...]) -> bool:
+        """Change le statut s'il fait partie de `allowed` ; False sinon (ou si le giveaway n'existe plus)."""
+        with self.conn:
+            return self.conn.execute(
+                f"UPDATE giveaways SET status = ? WHERE giveaway_key = ? AND status IN ({','.join('?' * len(allowed))})",
+                (status, giveaway_key, *allowed)).rowcount == 1
+
+    @staticmethod
+    def _from_row(row) -> tuple[str, dict]:
+        key, chat_id, thread_id, message_id, prize, role, end_time, host, winners, status = row
+        giveaway = { "prize": prize, "required_role": role, "end_time": datetime.datetime.fromisoformat(end_time), "host_mention": host, "winners_count": winners, "participants": ParticipantSet(), "message_id": message_id, "chat_id": chat_id, "message_thread_id": thread_id }
+        if status == 'closed': giveaway['closed'] = True
+        return key, giveaway
+
+    def load_all(self) -> dict[str, dict]:
+        """Reconstruit le dictionnaire des giveaways actifs (hors annulés), participants compris."""
+        giveaways = dict(map(self._from_row, self.conn.execute(f"SELECT {self.COLUMNS}, status FROM giveaways WHERE status != 'cancelled'")))
+        for key, user_id in self.conn.execute("SELECT giveaway_key, user_id FROM participants"):
+            giveaway = giveaways.get(key)
+            if giveaway is not None: giveaway['participants'].add(user_id)
+        return giveaways
+
+    def load(self, giveaway_key: str) -> dict | None:
+        """Un seul giveaway actif (créé par un autre worker), participants compris."""
+        row = self.conn.execute(f"SELECT {self.COLUMNS}, status FROM giveaways WHERE giveaway_key = ? AND status != 'cancelled'", (giveaway_key,)).fetchone()
+        if row is None: return None
+        giveaway = self._from_row(row)[1]
+        for (user_id,) in self.conn.execute("SELECT user_id FROM participants WHERE giveaway_key = ?", (giveaway_key,)): giveaway['participants'].add(user_id)
+        return giveaway
+
+
+# --- Planification des éditions de messages ---
+class MessageEditScheduler:
+    """Regroupe les éditions d'un même message et respecte les limites de débit de Telegram.
+
+    Chaque demande remplace la précédente encore en attente pour le même message (le dernier
+    état gagne) ; le rendu n'est calculé qu'au moment de l'envoi, et l'appel est sauté si le
+    texte n'a pas changé depuis la dernière édition réussie, sans consommer de créneau d'édition.
+    Seul un 429 est réessayé : après tout autre échec (message supprimé, droits retirés…), le
+    message est marqué en échec et les demandes suivantes sont ignorées.
+    """
+    def __init__(self, chat_min_interval: float, global_rate: float):
+        self.chat_min_interval, self.global_interval = chat_min_interval, 1.0 / global_rate
+        self._pending, self._tasks, self._last_text = {}, {}, {}
+        self._failed: set[tuple[int, int]] = set()
+        self._chat_next_slot: dict[int, float] = {}
+        self._global_next_slot = 0.0
+
+    def request(self, bot, chat_id: int, message_id: int, render):
+        """Demande une édition ; `render()` retourne (texte, clavier) ou None pour abandonner."""
+        key = (chat_id, message_id)
+        if key in self._failed: return
+        metrics.inc("message_edits_total", result="requested")
+        if key in self._pending: metrics.inc("message_edits_total", result="coalesced")
+        self._pending[key] = (bot, render)
+        if key not in self._tasks: self._tasks[key] = asyncio.create_task(self._run(key))
+
+    def forget(self, chat_id: int, message_id: int):
+        """Abandonne toute édition en attente pour ce message (tirage, annulation)."""
+        key = (chat_id, message_id)
+        self._pending.pop(key, None)
+        self._last_text.pop(key, None)
+        self._failed.discard(key)
+        task = self._tasks.pop(key, None)
+        if task and task is not asyncio.current_task(): task.cancel()
+
+    def has_failed(self, chat_id: int, message_id: int) -> bool:
+        """True si le message ne peut plus être édité (échec définitif d'une édition précédente)."""
+        return (chat_id, message_id) in self._failed
+
+    async def _wait_for_slot(self, chat_id: int):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._chat_next_slot.get(chat_id, 0.0), self._global_next_slot)
+        self._chat_next_slot[chat_id] = slot + self.chat_min_interval
+        self._global_next_slot = slot + self.global_interval
+        if slot > now: await asyncio.sleep(slot - now)
+
+    def _defer_chat(self, chat_id: int, delay: float):
+        loop = asyncio.get_running_loop()
+        self._chat_next_slot[chat_id] = max(self._chat_next_slot.get(chat_id, 0.0), loop.time() + delay)
+
+    async def _run(self, key):
+        chat_id, message_id = key
+        try:
+            while key in self._pending:
+                # Rien de visible n'a changé : on n'utilise même pas de créneau d'édition
+                rendered = self._pending[key][1]()
+                if rendered is None or self._last_text.get(key) == rendered[0]:
+                    if rendered is not None: metrics.inc("message_edits_total", result="unchanged")
+                    del self._pending[key]
+                    continue
+                await self._wait_for_slot(chat_id)
+                if key not in self._pending: break
+                bot, render = self._pending.pop(key)
+                rendered = render()
+                if rendered is None: continue
+                text, reply_markup = rendered
+                if self._last_text.get(key) == text:
+                    metrics.inc("message_edits_total", result="unchanged")
+                    continue
+                try:
+                    await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=reply_markup, parse_mode=constants.ParseMode.MARKDOWN_V2)
+                    metrics.inc("message_edits_total", result="sent")
+                    self._last_text[key] = text
+                except telegram.error.RetryAfter as e:
+                    metrics.inc("message_edits_total", result="throttled")
+                    count_telegram_error(e)
+                    self._defer_chat(chat_id, retry_after_seconds(e))
+                    # On réessaiera avec le rendu le plus récent, sauf si une nouvelle demande l'a déjà remplacé
+                    self._pending.setdefault(key, (bot, render))
+                except Exception as e:
+                    if isinstance(e, telegram.error.BadRequest) and "Message is not modified" in str(e):
+                        self._last_text[key] = text
+                        continue
+                    metrics.inc("message_edits_total", result="failed")
+                    count_telegram_error(e)
+                    logger.warning("Ne peut pas éditer le message %s, éditions abandonnées : %s", key, e)
+                    self._pending.pop(key, None)
+                    self._failed.add(key)
+        finally:
+            if self._tasks.get(key) is asyncio.current_task(): del self._tasks[key]
+
+def retry_after_seconds(error: telegram.error.RetryAfter) -> float:
+    return error.retry_after.total_seconds() if isinstance(error.retry_after, datetime.timedelta) else error.retry_after
+
+async def send_with_retry(send, attempts: int = 3):
+    """Envoi qui ne doit pas être perdu (annonce des gagnants) : on attend le délai imposé par un 429 et on réessaie."""
+    for attempt in range(attempts):
+        try: return await send()
+        except telegram.error.RetryAfter as e:
+            count_telegram_error(e)
+            if attempt == attempts - 1: raise
+            await asyncio.sleep(retry_after_seconds(e))
+
+edit_scheduler = MessageEditScheduler(EDIT_CHAT_MIN_INTERVAL, EDIT_GLOBAL_RATE)
+
+def render_giveaway_update(giveaway_key: str):
+    """Rendu (texte, clavier) d'un giveaway actif pour le planificateur d'éditions, ou None s'il est terminé."""
+    giveaway = active_giveaways.get(giveaway_key)
+    if giveaway is None or giveaway.get('closed'): return None
+    return format_giveaway_message(giveaway_key), giveaway_keyboard(giveaway_key)
+
+def request_giveaway_update(bot, giveaway_key: str):
+    """Demande la mise à jour (regroupée et limitée en débit) du message d'un giveaway."""
     giveaway = active_giveaways[giveaway_key]
-    new_text = format_giveaway_message(giveaway_key)
-    keyboard = [[InlineKeyboardButton("🎉 Participer", callback_data=f'participate_{giveaway_key}')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    edit_scheduler.request(bot, giveaway['chat_id'], giveaway['message_id'], lambda: render_giveaway_update(giveaway_key))
+
+# --- Inscriptions des participants ---
+class ParticipationPipeline:
+    """Tampon d'inscriptions en ajout seul, vidé par lots par une tâche de fond.
+
+    Le clic n'effectue qu'une vérification de doublon et un ajout au tampon avant d'être acquitté ;
+    la tâche consommatrice applique ensuite les inscriptions aux giveaways et ne demande qu'un seul
+    rendu par giveaway et par lot.
+    """
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self._buffer = collections.deque()
+        self._pending: dict[str, set[int]] = {}
+        self._wakeup = asyncio.Event()
+        self._consumer, self._bot = None, None
+
+    def submit(self, giveaway_key: str, user_id: int, full_name: str) -> bool:
+        """Enregistre une inscription ; retourne False si l'utilisateur participe déjà."""
+        if user_id in active_giveaways[giveaway_key]['participants']: return False
+        pending = self._pending.setdefault(giveaway_key, set())
+        if user_id in pending: return False
+        pending.add(user_id)
+        self._buffer.append((giveaway_key, user_id, full_name))
+        self._wakeup.set()
+        return True
+
+    def apply_pending(self, max_items: int | None = None) -> set[str]:
+        """Applique (une partie de) le tampon aux giveaways et retourne les clés modifiées."""
+        touched, rows, names = set(), [], []
+        count = len(self._buffer) if max_items is None else min(max_items, len(self._buffer))
+        for _ in range(count):
+            giveaway_key, user_id, full_name = self._buffer.popleft()
+            pending = self._pending.get(giveaway_key)
+            if pending is not None:
+                pending.discard(user_id)
+                if not pending: del self._pending[giveaway_key]
+            giveaway = active_giveaways.get(giveaway_key)
+            if giveaway is None: continue
+            giveaway['participants'].add(user_id)
+            rows.append((giveaway_key, user_id))
+            names.append((user_id, full_name))
+            touched.add(giveaway_key)
+        if rows:
+            # Même thread d'E/S pour les deux tables : les noms sont écrits avant toute lecture au tirage
+            name_store.submit(name_store.save, names)
+            giveaway_store.submit(giveaway_store.add_participants, rows)
+        return touched
+
+    def discard(self, giveaway_key: str):
+        """Oublie les inscriptions en attente d'un giveaway terminé ou annulé."""
+        self._pending.pop(giveaway_key, None)
+
+    def start(self, bot):
+        self._bot = bot
+        if self._consumer is None: self._consumer = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._consumer is None: return
+        self._consumer.cancel()
+        try: await self._consumer
+        except asyncio.CancelledError: pass
+        self._consumer = None
+        self.apply_pending()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._buffer:
+                for giveaway_key in self.apply_pending(self.batch_size):
+                    if giveaway_key in active_giveaways: request_giveaway_update(self._bot, giveaway_key)
+                # On laisse la main aux clics en attente entre deux lots
+                await asyncio.sleep(0)
+
+participation_pipeline = ParticipationPipeline(PARTICIPATION_BATCH_SIZE)
+
+# --- Anti-spam des clics ---
+class ClickGuard:
+    """Filtre en mémoire des clics répétés, consulté avant tout le reste du handler de participation.
+
+    - un seau à jetons par utilisateur (CLICK_BURST clics d'affilée, puis CLICK_RATE par seconde) ;
+    - un cache des couples (utilisateur, giveaway) déjà inscrits, à durée de vie fixe : les entrées
+      sont donc rangées par date d'expiration dans l'OrderedDict, et l'éviction se fait par le début.
+    Les deux structures sont bornées en taille ; un seau plein (utilisateur inactif) équivaut à un
+    seau absent et peut être évincé sans effet.
+    """
+    def __init__(self, dedup_ttl: float, dedup_max_entries: int, burst: int, rate: float, max_users: int):
+        self.dedup_ttl, self.dedup_max_entries = dedup_ttl, dedup_max_entries
+        self.burst, self.rate, self.max_users = burst, rate, max_users
+        self._joined: collections.OrderedDict[tuple[int, str], float] = collections.OrderedDict()
+        self._buckets: collections.OrderedDict[int, list[float]] = collections.OrderedDict()
+
+    def allow(self, user_id: int) -> bool:
+        """Consomme un jeton du seau de l'utilisateur ; False s'il clique trop vite."""
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [float(self.burst), now]
+            if len(self._buckets) > self.max_users: self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1: return False
+        bucket[0] -= 1
+        return True
+
+    def has_joined(self, user_id: int, giveaway_key: str) -> bool:
+        expires_at = self._joined.get((user_id, giveaway_key))
+        return expires_at is not None and expires_at > time.monotonic()
+
+    def remember(self, user_id: int, giveaway_key: str):
+        """Mémorise une participation confirmée (nouvelle ou déjà existante)."""
+        now = time.monotonic()
+        key = (user_id, giveaway_key)
+        self._joined.pop(key, None)
+        self._joined[key] = now + self.dedup_ttl
+        while self._joined:
+            oldest_key, expires_at = next(iter(self._joined.items()))
+            if expires_at > now and len(self._joined) <= self.dedup_max_entries: break
+            del self._joined[oldest_key]
+
+click_guard = ClickGuard(CLICK_DEDUP_TTL, CLICK_DEDUP_MAX_ENTRIES, CLICK_BURST, CLICK_RATE, CLICK_RATE_MAX_USERS)
+
+# --- Tirage au sort ---
+class AliasSampler:
+    """Tirage pondéré en O(1) par la méthode des alias (Vose), construit en O(n).
+
+    Les tables `prob` et `alias` sont des arrays, stockables tels quels dans l'historique pour que
+    les rerolls n'aient pas à recalculer les poids de tous les participants.
+    """
+    __slots__ = ("prob", "alias")
+
+    def __init__(self, prob: array, alias: array):
+        self.prob, self.alias = prob, alias
+
+    @classmethod
+    def from_weights(cls, weights: list[float]) -> 'AliasSampler':
+        n, total = len(weights), sum(weights)
+        scaled = [w * n / total for w in weights]
+        prob, alias = array('d', bytes(8 * n)), array('q', bytes(8 * n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s], alias[s] = scaled[s], l
+            scaled[l] += scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        for i in large + small: prob[i], alias[i] = 1.0, i
+        return cls(prob, alias)
+
+    def sample(self, rng: random.Random) -> int:
+        i = rng.randrange(len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+    def weights(self) -> list[float]:
+        """Poids relatifs reconstitués à partir des tables (pour le tirage exact de secours)."""
+        weights = list(self.prob)
+        for i, p in enumerate(self.prob):
+            if p < 1.0: weights[self.alias[i]] += 1.0 - p
+        return weights
+
+def build_draw_pool(participant_ids: array, required_role: str | None) -> tuple[array, AliasSampler | None]:
+    """Filtre les participants éligibles en une seule passe et calcule leurs tickets (ROLE_WEIGHTS).
+
+    Retourne les identifiants éligibles (sans rôle requis, `participant_ids` lui-même) et, si au moins
+    un participant a un poids différent de 1, l'échantillonneur pondéré correspondant.
+    """
+    admins = set(ADMIN_USER_IDS)
+    if required_role:
+        if not role_store.role_exists(required_role): return array('q'), None
+        members = role_store.members(required_role)
+        pool = array('q', [uid for uid in participant_ids if uid in members or uid in admins])
+    else: pool = participant_ids
+    weighted_roles = [(role_store.members(role_name), weight) for role_name, weight in ROLE_WEIGHTS.items() if weight != 1 and role_store.role_exists(role_name)]
+    if not pool or not weighted_roles: return pool, None
+    # Un participant ayant plusieurs rôles pondérés garde le poids le plus élevé
+    weights = [1] * len(pool)
+    for members, weight in weighted_roles:
+        weights = [weight if weight > current and uid in members else current for uid, current in zip(pool, weights)]
+    return pool, AliasSampler.from_weights(weights)
+
+def pick_winners(pool: array, sampler: AliasSampler | None, k: int, rng: random.Random, exclude=()) -> list[int]:
+    """Tire jusqu'à k gagnants distincts du pool, hors `exclude`, de façon reproductible à partir de `rng`.
+
+    Le tirage par rejet coûte O(k) en moyenne tant que k reste petit devant le pool ; s'il rejette
+    trop (pool presque épuisé), on termine par un tirage exact pondéré (Efraimidis-Spirakis) en O(n log k).
+    """
+    chosen, winners = set(exclude), []
+    k = min(k, len(pool))
+    attempts, max_attempts = 0, 32 * (k + len(chosen)) + 64
+    while len(winners) < k and attempts < max_attempts:
+        attempts += 1
+        uid = pool[sampler.sample(rng) if sampler else rng.randrange(len(pool))]
+        if uid in chosen: continue
+        chosen.add(uid)
+        winners.append(uid)
+    if len(winners) < k:
+        weights = sampler.weights() if sampler else None
+        keys = ((rng.random() ** (1.0 / weights[i]) if weights else rng.random(), pool[i]) for i in range(len(pool)) if pool[i] not in chosen)
+        winners += [uid for _, uid in heapq.nlargest(k - len(winners), keys)]
+    return winners
+
+def replay_draw(entry: dict) -> list[int] | None:
+    """Rejoue le tirage initial et les rerolls d'une entrée d'historique à partir de sa graine."""
+    if entry['seed'] is None: return None
+    pool, sampler, rerolls = entry['pool_ids'], entry['sampler'], entry['rerolls']
+    winners = pick_winners(pool, sampler, len(entry['winner_ids']) - rerolls, random.Random(entry['seed']))
+    for reroll in range(1, rerolls + 1):
+        winners += pick_winners(pool, sampler, 1, random.Random(f"{entry['seed']}:{reroll}"), exclude=winners)
+    return winners
+
+# --- Tâches planifiées (Jobs) ---
+class CountdownTicker:
+    """Ticker unique qui rafraîchit le compte à rebours de tous les giveaways actifs.
+
+    Les prochains rafraîchissements sont rangés dans un tas (heure, génération, clé) ; à chaque
+    tick, tous ceux qui sont dus sont traités d'un coup. Le désenregistrement est en O(1) : l'entrée
+    du tas devient simplement obsolète et est ignorée quand elle ressort.
+    """
+    def __init__(self, intervals: list[tuple[int, int]]):
+        self.intervals = intervals
+        self._heap: list[tuple[float, int, str]] = []
+        self._generations: dict[str, int] = {}
+        self._next_generation = 0
+
+    def interval_for(self, giveaway_key: str) -> float:
+        end_time = active_giveaways[giveaway_key]['end_time']
+        remaining = (end_time - datetime.datetime.now(end_time.tzinfo)).total_seconds()
+        for min_remaining, interval in self.intervals:
+            if remaining > min_remaining: return interval
+        return self.intervals[-1][1]
+
+    def register(self, giveaway_key: str):
+        self._next_generation += 1
+        self._generations[giveaway_key] = self._next_generation
+        self._push(giveaway_key, time.monotonic() + self.interval_for(giveaway_key))
+
+    def unregister(self, giveaway_key: str):
+        self._generations.pop(giveaway_key, None)
+
+    def _push(self, giveaway_key: str, when: float):
+        heapq.heappush(self._heap, (when, self._generations[giveaway_key], giveaway_key))
+
+    def due(self) -> list[str]:
+        """Retire du tas les giveaways à rafraîchir maintenant et replanifie leur prochain passage."""
+        now, due = time.monotonic(), []
+        while self._heap and self._heap[0][0] <= now:
+            _, generation, giveaway_key = heapq.heappop(self._heap)
+            if self._generations.get(giveaway_key) != generation: continue
+            if giveaway_key not in active_giveaways:
+                del self._generations[giveaway_key]
+                continue
+            due.append(giveaway_key)
+            self._push(giveaway_key, now + self.interval_for(giveaway_key))
+        return due
+
+countdown_ticker = CountdownTicker(COUNTDOWN_INTERVALS)
+
+# --- État partagé entre workers ---
+def drop_local_giveaway(giveaway_key: str, cancel_draw: bool = True):
+    """Oublie un giveaway dans ce worker (terminé, annulé ou tiré ailleurs), sans toucher au stockage."""
+    giveaway = active_giveaways.get(giveaway_key)
+    if giveaway is None: return
+    if cancel_draw and giveaway.get('draw_job'): giveaway['draw_job'].schedule_removal()
+    countdown_ticker.unregister(giveaway_key)
+    edit_scheduler.forget(giveaway['chat_id'], giveaway['message_id'])
+    participation_pipeline.discard(giveaway_key)
+    del active_giveaways[giveaway_key]
+
+class LocalStateBackend:
+    """Un seul worker (par défaut) : l'état en mémoire fait foi, il n'y a rien à coordonner."""
+    shared = False
+
+    async def add_participant(self, bot, giveaway_key: str, user_id: int, full_name: str) -> bool | None:
+        """Inscrit un utilisateur ; True si nouveau, False s'il participait déjà, None si le giveaway n'existe plus."""
+        return participation_pipeline.submit(giveaway_key, user_id, full_name)
+
+    def holds(self, lease: str) -> bool: return True
+    async def claim_draw(self, giveaway_key: str) -> bool | None: return True
+    async def request_cancel(self, giveaway_key: str) -> bool: return True
+    async def refresh_participants(self, giveaway_key: str): pass
+    async def load_giveaway(self, job_queue, giveaway_key: str) -> dict | None: return None
+    async def start(self): pass
+    async def sync(self, job_queue) -> tuple[set[str], list[tuple]]: return set(), []
+
+class SQLiteStateBackend(SQLiteStore):
+    """Plusieurs workers partageant GIVEAWAYS_DB (même machine ou volume partagé).
+
+    Les inscriptions sont écrites de façon atomique (INSERT OR IGNORE sur la clé primaire de
+    participants) : la base tranche les doublons, même quand deux workers reçoivent le même clic.
+    Les clics concurrents sont regroupés dans une seule transaction, et chaque inscription est
+    ajoutée au journal participant_feed que les autres workers rejouent pour rester à jour.
+    Des baux désignent le seul worker qui édite le compte à rebours d'un giveaway et celui qui
+    effectue son tirage ; le bail d'un worker arrêté expire et est repris par un autre. Une annulation
+    marque seulement le giveaway ('cancelled') : c'est le détenteur du bail du compte à rebours, seul
+    à éditer le message, qui écrit l'annonce d'annulation puis supprime le giveaway.
+    """
+    shared = True
+
+    def __init__(self, path: str, worker_id: str, lease_ttl: float):
+        super().__init__(path)
+        self.worker_id, self.lease_ttl = worker_id, lease_ttl
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS participant_feed (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, giveaway_key TEXT NOT NULL, user_id INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS participant_feed_by_giveaway ON participant_feed (giveaway_key);
+        """)
+        self._held: dict[str, float] = {}
+        self._claims, self._claim_task = [], None
+        self._feed_cursor, self._known_keys = 0, set()
+
+    # Méthodes synchrones, exécutées dans le thread d'E/S du fichier
+    def _claim_batch(self, claims: list[tuple[str, int, str]]) -> list[bool | None]:
+        results = []
+        with self.conn:
+            for giveaway_key, user_id, full_name in claims:
+                inserted = self.conn.execute(
+                    "INSERT OR IGNORE INTO participants SELECT ?, ? WHERE EXISTS (SELECT 1 FROM giveaways WHERE giveaway_key = ? AND status = 'open')",
+                    (giveaway_key, user_id, giveaway_key)).rowcount == 1
+                if inserted:
+                    self.conn.execute("INSERT INTO participant_feed (giveaway_key, user_id) VALUES (?, ?)", (giveaway_key, user_id))
+                    self.conn.execute(UserNameStore.UPSERT, (user_id, full_name))
+                    results.append(True)
+                else:
+                    exists = self.conn.execute("SELECT 1 FROM participants WHERE giveaway_key = ? AND user_id = ?", (giveaway_key, user_id)).fetchone()
+                    results.append(False if exists else None)
+        return results
+
+    def _acquire(self, names: list[str], now: float) -> set[str]:
+        """Prend ou prolonge les baux demandés ; retourne ceux qui appartiennent désormais à ce worker."""
+        acquired = set()
+        with self.conn:
+            for name in names:
+                cursor = self.conn.execute(
+                    "INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at"
+                    " WHERE leases.owner = excluded.owner OR leases.expires_at < ?", (name, self.worker_id, now + self.lease_ttl, now))
+                if cursor.rowcount == 1: acquired.add(name)
+        return acquired
+
+    def _snapshot(self) -> tuple[int, set[str]]:
+        cursor = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM participant_feed").fetchone()[0]
+        return cursor, {key for (key,) in self.conn.execute("SELECT giveaway_key FROM giveaways WHERE status != 'cancelled'")}
+
+    def _status(self, giveaway_key: str) -> str | None:
+        row = self.conn.execute("SELECT status FROM giveaways WHERE giveaway_key = ?", (giveaway_key,)).fetchone()
+        return row[0] if row else None
+
+    def _changes(self, cursor: int, known_keys: frozenset, leases: list[str], now: float):
+        """Giveaways existants, annulations en attente, inscriptions du journal après `cursor`, et baux pris ou prolongés.
+
+        Le bail du compte à rebours de chaque giveaway annulé est demandé aussi : seul son détenteur l'obtient
+        (ou n'importe quel worker s'il a expiré), et c'est lui qui termine l'annulation.
+        """
+        keys, cancelled = set(), []
+        for key, status, chat_id, message_id, prize in self.conn.execute("SELECT giveaway_key, status, chat_id, message_id, prize FROM giveaways"):
+            if status == 'cancelled': cancelled.append((key, chat_id, message_id, prize))
+            else: keys.add(key)
+        rows = self.conn.execute("SELECT seq, giveaway_key, user_id FROM participant_feed WHERE seq > ? ORDER BY seq", (cursor,)).fetchall()
+        acquired = self._acquire(leases + [f"countdown:{key}" for key, *_ in cancelled], now)
+        vanished = known_keys - keys
+        with self.conn:
+            for key in vanished: self.conn.execute("DELETE FROM participant_feed WHERE giveaway_key = ?", (key,))
+            self.conn.execute("DELETE FROM leases WHERE expires_at < ?", (now - self.lease_ttl,))
+        return keys, rows, acquired, cancelled
+
+    # Interface utilisée par les handlers
+    async def add_participant(self, bot, giveaway_key: str, user_id: int, full_name: str) -> bool | None:
+        giveaway = active_giveaways[giveaway_key]
+        if user_id in giveaway['participants']: return False
+        future = asyncio.get_running_loop().create_future()
+        self._claims.append((giveaway_key, user_id, full_name, future))
+        if self._claim_task is None: self._claim_task = asyncio.create_task(self._write_claims())
+        accepted = await future
+        if accepted is None: return None
+        if giveaway['participants'].add(user_id) and giveaway_key in active_giveaways and self.holds(f"countdown:{giveaway_key}"):
+            request_giveaway_update(bot, giveaway_key)
+        return accepted
+
+    async def _write_claims(self):
+        """Écrit les clics en attente par lots : une transaction pour tous ceux arrivés pendant la précédente."""
+        try:
+            while self._claims:
+                batch, self._claims = self._claims, []
+                try: results = await self.run(self._claim_batch, [claim[:3] for claim in batch])
+                except Exception as e:
+                    for *_, future in batch:
+                        if not future.done(): future.set_exception(e)
+                    continue
+                for (*_, future), accepted in zip(batch, results):
+                    if not future.done(): future.set_result(accepted)
+        finally: self._claim_task = None
+
+    def holds(self, lease: str) -> bool:
+        # Marge de sécurité : on cesse d'agir avant l'expiration si les renouvellements échouent
+        return self._held.get(lease, 0.0) > time.time() + self.lease_ttl / 4
+
+    async def acquire(self, lease: str) -> bool:
+        now = time.time()
+        if lease in await self.run(self._acquire, [lease], now):
+            self._held[lease] = now + self.lease_ttl
+            return True
+        self._held.pop(lease, None)
+        return False
+
+    async def claim_draw(self, giveaway_key: str) -> bool | None:
+        """Bail de tirage : True si ce worker tire (le giveaway passe en 'closed' et refuse les inscriptions),
+        False si un autre worker détient le bail, None si le giveaway a été annulé ou déjà tiré."""
+        if not await self.acquire(f"draw:{giveaway_key}"):
+            metrics.inc("leases_total", kind="draw", result="lost")
+            return None if await self.run(self._status, giveaway_key) in (None, 'cancelled') else False
+        metrics.inc("leases_total", kind="draw", result="acquired")
+        # 'closed' est accepté aussi : reprise du tirage d'un worker arrêté en route
+        return await giveaway_store.run(giveaway_store.set_status, giveaway_key, 'closed', ('open', 'closed')) or None
+
+    async def request_cancel(self, giveaway_key: str) -> bool:
+        """Marque le giveaway annulé ; False si son tirage a déjà commencé (ou s'il n'existe plus)."""
+        return await giveaway_store.run(giveaway_store.set_status, giveaway_key, 'cancelled', ('open',))
+
+    async def refresh_participants(self, giveaway_key: str):
+        """Relit tous les participants avant le tirage, y compris ceux inscrits via les autres workers."""
+        stored = await giveaway_store.run(giveaway_store.load, giveaway_key)
+        if stored is not None and giveaway_key in active_giveaways: active_giveaways[giveaway_key]['participants'] = stored['participants']
+
+    async def load_giveaway(self, job_queue, giveaway_key: str) -> dict | None:
+        """Charge un giveaway créé par un autre worker et planifie ses jobs ici aussi."""
+        giveaway = await giveaway_store.run(giveaway_store.load, giveaway_key)
+        if giveaway is not None and giveaway_key not in active_giveaways:
+            active_giveaways[giveaway_key] = giveaway
+            schedule_giveaway_jobs(job_queue, giveaway_key)
+        return active_giveaways.get(giveaway_key)
+
+    async def start(self):
+        self._feed_cursor, self._known_keys = await self.run(self._snapshot)
+
+    async def sync(self, job_queue) -> tuple[set[str], list[tuple]]:
+        """Rattrape les autres workers.
+
+        Retourne les giveaways dont le nombre de participants a changé, et les annulations que ce worker
+        doit terminer (chat_id, message_id, prix) parce qu'il détient le bail de leur compte à rebours.
+        """
+        now = time.time()
+        leases = [f"countdown:{key}" for key in active_giveaways if self._held.get(f"countdown:{key}", 0.0) < now + self.lease_ttl / 2]
+        keys, rows, acquired, cancelled = await self.run(self._changes, self._feed_cursor, frozenset(self._known_keys), leases, now)
+        for lease in leases:
+            if lease in acquired: self._held[lease] = now + self.lease_ttl
+            else: self._held.pop(lease, None)
+        self._held = {lease: expires_at for lease, expires_at in self._held.items() if expires_at > now}
+        # Tirés ou annulés par un autre worker ; ceux créés ici et pas encore enregistrés ne sont pas concernés
+        for key in self._known_keys - keys: drop_local_giveaway(key)
+        for key in keys - self._known_keys:
+            if key not in active_giveaways: await self.load_giveaway(job_queue, key)
+        self._known_keys = keys
+        touched = set()
+        for _, giveaway_key, user_id in rows:
+            giveaway = active_giveaways.get(giveaway_key)
+            if giveaway is not None and giveaway['participants'].add(user_id): touched.add(giveaway_key)
+        if rows: self._feed_cursor = rows[-1][0]
+        cancellations = []
+        for giveaway_key, chat_id, message_id, prize in cancelled:
+            drop_local_giveaway(giveaway_key)
+            if f"countdown:{giveaway_key}" in acquired: cancellations.append((giveaway_key, chat_id, message_id, prize))
+        await role_store.reload_if_changed()
+        return touched, cancellations
+
+# --- Stockages : ouverts par open_stores() au lancement du bot, jamais à l'import ---
+role_store: RoleStore | None = None
+name_store: UserNameStore | None = None
+history_store: HistoryStore | None = None
+giveaway_store: GiveawayStore | None = None
+state_backend: SQLiteStateBackend | LocalStateBackend | None = None
+
+def open_stores(db_path: str = GIVEAWAYS_DB, roles_path: str = ROLES_FILE, shared: bool = STATE_BACKEND == 'sqlite', worker_id: str = WORKER_ID):
+    """Ouvre les fichiers du bot (lecture de roles.json, connexions SQLite) ; les bancs d'essai l'appellent avec leurs propres chemins."""
+    global role_store, name_store, history_store, giveaway_store, state_backend
+    role_store = RoleStore(roles_path, ROLES_FLUSH_DELAY)
+    name_store = UserNameStore(db_path)
+    history_store = HistoryStore(db_path)
+    giveaway_store = GiveawayStore(db_path)
+    state_backend = SQLiteStateBackend(db_path, worker_id, LEASE_TTL) if shared else LocalStateBackend()
+
+def close_stores():
+    """Écrit les rôles en attente, termine les écritures en cours et ferme les connexions (bloquant, pour l'arrêt)."""
+    role_store.flush()
+    for executor in _io_executors.values(): executor.shutdown(wait=True)
+    _io_executors.clear()
+    for store in (name_store, history_store, giveaway_store, state_backend):
+        if isinstance(store, SQLiteStore): store.conn.close()
+
+@instrumented
+async def countdown_tick_job(context: ContextTypes.DEFAULT_TYPE):
+    for giveaway_key in countdown_ticker.due():
+        giveaway = active_giveaways[giveaway_key]
+        # Message supprimé ou droits retirés : le compte à rebours s'arrête, le tirage aura lieu quand même
+        if edit_scheduler.has_failed(giveaway['chat_id'], giveaway['message_id']): countdown_ticker.unregister(giveaway_key)
+        # Avec plusieurs workers, seul le détenteur du bail édite le message
+        elif state_backend.holds(f"countdown:{giveaway_key}"): request_giveaway_update(context.bot, giveaway_key)
+
+async def show_cancelled(bot, chat_id: int, message_id: int, prize: str):
+    cancelled_text = f"❌ *GIVEAWAY ANNULÉ* ❌\n\nLe concours pour *{prize}* a été annulé par un administrateur\\."
     try:
-        await context.bot.edit_message_text(chat_id=giveaway['chat_id'], message_id=giveaway['message_id'], text=new_text, reply_markup=reply_markup, parse_mode=constants.ParseMode.MARKDOWN_V2)
+        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=cancelled_text, parse_mode=constants.ParseMode.MARKDOWN_V2, reply_markup=None)
     except Exception as e:
-        if "Message is not modified" not in str(e):
-            print(f"Erreur compte à rebours: {e}")
-            context.job.schedule_removal()
+        count_telegram_error(e)
+        logger.warning("Erreur en éditant le message d'annulation : %s", e)
 
-async def final_minute_trigger_job(context: ContextTypes.DEFAULT_TYPE):
-    giveaway_key = context.job.data['giveaway_key']
-    print(f"Giveaway {giveaway_key}: Passage au décompte final.")
-    slow_update_jobs = context.job_queue.get_jobs_by_name(f"gw_update_slow_{giveaway_key}")
-    for job in slow_update_jobs: job.schedule_removal()
-    context.job_queue.run_repeating(update_countdown_job, interval=3, data={"giveaway_key": giveaway_key}, name=f"gw_update_fast_{giveaway_key}")
+@instrumented
+async def shared_state_job(context: ContextTypes.DEFAULT_TYPE):
+    """Synchronisation périodique avec les autres workers (STATE_BACKEND=sqlite)."""
+    touched, cancellations = await state_backend.sync(context.job_queue)
+    for giveaway_key in touched:
+        if state_backend.holds(f"countdown:{giveaway_key}"): request_giveaway_update(context.bot, giveaway_key)
+    # Seul éditeur du message, le détenteur du bail écrit l'annonce d'annulation après ses propres éditions
+    for giveaway_key, chat_id, message_id, prize in cancellations:
+        await show_cancelled(context.bot, chat_id, message_id, prize)
+        await giveaway_store.run(giveaway_store.delete_giveaway, giveaway_key)
 
+@instrumented
 async def draw_winners_callback(context: ContextTypes.DEFAULT_TYPE):
     """Effectue le tirage, avec une mise à jour finale et une pause."""
     giveaway_key = context.job.data['giveaway_key']
-    for job_name in [f"gw_update_slow_{giveaway_key}", f"gw_update_fast_{giveaway_key}"]:
-        for job in context.job_queue.get_jobs_by_name(job_name):
-            job.schedule_removal()
+    countdown_ticker.unregister(giveaway_key)
+    if giveaway_key not in active_giveaways: return
+    claimed = await state_backend.claim_draw(giveaway_key)
+    # Annulé, ou déjà tiré par un autre worker
+    if claimed is None: return drop_local_giveaway(giveaway_key, cancel_draw=False)
     if giveaway_key not in active_giveaways: return
-    
     giveaway = active_giveaways[giveaway_key]
+    if not claimed:
+        # Un autre worker effectue ce tirage ; s'il s'arrête en route, on le reprendra à l'expiration de son bail
+        giveaway['closed'] = True
+        edit_scheduler.forget(giveaway['chat_id'], giveaway['message_id'])
+        giveaway['draw_job'] = context.job_queue.run_once(draw_winners_callback, when=LEASE_TTL + SHARED_SYNC_INTERVAL, data={"giveaway_key": giveaway_key}, name=f"gw_draw_{giveaway_key}")
+        return
+    
+    # Plus aucune inscription à partir d'ici : seules celles déjà dans le tampon seront appliquées
+    giveaway['closed'] = True
     chat_id, message_thread_id = giveaway['chat_id'], giveaway['message_thread_id']
+    edit_scheduler.forget(chat_id, giveaway['message_id'])
 
     try:
         await context.bot.edit_message_text(
@@ -128,56 +1395,78 @@ async def draw_winners_callback(context: ContextTypes.DEFAULT_TYPE):
         )
         await asyncio.sleep(2)
     except Exception as e:
-        print(f"Erreur lors de la mise à jour finale du message : {e}")
+        count_telegram_error(e)
+        logger.warning("Erreur lors de la mise à jour finale du message : %s", e)
 
-    participants, prize = giveaway['participants'], giveaway['prize']
+    # Les inscriptions encore dans le tampon (ou reçues par les autres workers) comptent pour le tirage
+    participation_pipeline.apply_pending()
+    participation_pipeline.discard(giveaway_key)
+    await state_backend.refresh_participants(giveaway_key)
+    # Instantané figé des participants : c'est exactement ce qui est tiré et enregistré dans l'historique
+    participant_ids, prize = array('q', giveaway['participants'].ids), giveaway['prize']
     final_message, winner_ids = f"🎉 Le giveaway pour *{prize}* est terminé \\! 🎉\n\n", []
-    required_role, valid_participants = giveaway.get("required_role"), {}
-    if required_role:
-        roles = load_roles()
-        if required_role in roles:
-            for uid_str, uname in participants.items():
-                uid = int(uid_str)
-                if uid in roles[required_role] or uid in ADMIN_USER_IDS: valid_participants[uid_str] = uname
-    else: valid_participants = participants
-    valid_participant_ids = list(valid_participants.keys())
-    winners_count = min(giveaway['winners_count'], len(valid_participant_ids))
-    if not valid_participant_ids:
+    pool, sampler = build_draw_pool(participant_ids, giveaway.get("required_role"))
+    # Graine publiée avec les gagnants : le tirage peut être rejoué et vérifié avec /verifier_tirage
+    seed = secrets.randbits(63)
+    if not pool:
         final_message += "Malheureusement, aucun participant valide n'a été trouvé pour ce giveaway\\. 😕"
     else:
-        winner_ids_str = random.sample(valid_participant_ids, k=winners_count)
-        winner_ids = [int(wid) for wid in winner_ids_str]
-        mentions = [f"🏆 [{escape_markdown_v2(valid_participants[wid_str])}](tg://user?id={wid_str})" for wid_str in winner_ids_str]
-        final_message += "Félicitations aux gagnants :\n" + "\n".join(mentions)
+        winner_ids = pick_winners(pool, sampler, giveaway['winners_count'], random.Random(seed))
+        # Seuls les noms des gagnants sont relus
+        names = await name_store.run(name_store.get, winner_ids)
+        mentions = [f"🏆 [{escape_markdown_v2(names.get(wid, str(wid)))}](tg://user?id={wid})" for wid in winner_ids]
+        final_message += "Félicitations aux gagnants :\n" + "\n".join(mentions) + f"\n\n_Graine du tirage :_ `{seed}`"
     
-    winner_announcement_message = await context.bot.send_message(chat_id, final_message, parse_mode=constants.ParseMode.MARKDOWN_V2, message_thread_id=message_thread_id)
+    metrics.inc("draws_total")
+    logger.info("Tirage du giveaway %s : %d gagnant(s) parmi %d éligible(s), graine %d", giveaway_key, len(winner_ids), len(pool), seed)
+    winner_announcement_message = await send_with_retry(lambda: context.bot.send_message(chat_id, final_message, parse_mode=constants.ParseMode.MARKDOWN_V2, message_thread_id=message_thread_id))
 
-    history = load_history()
-    history_entry = { "prize": giveaway['prize'], "participants": giveaway['participants'], "winner_ids": winner_ids, "chat_id": chat_id, "message_thread_id": message_thread_id }
-    history[str(winner_announcement_message.message_id)] = history_entry
-    save_history(history)
+    history_entry = { "prize": giveaway['prize'], "participant_ids": participant_ids, "winner_ids": winner_ids, "chat_id": chat_id, "message_thread_id": message_thread_id,
+                      "seed": seed, "pool_ids": pool, "sampler": sampler, "rerolls": 0 }
+    await history_store.run(history_store.append, winner_announcement_message.message_id, history_entry)
 
     if giveaway_key in active_giveaways:
         del active_giveaways[giveaway_key]
+    await giveaway_store.run(giveaway_store.delete_giveaway, giveaway_key)
+
+@instrumented
+async def compact_history_job(context: ContextTypes.DEFAULT_TYPE):
+    """Purge quotidienne de l'historique au-delà de HISTORY_RETENTION_DAYS."""
+    deleted = await history_store.run(history_store.compact, HISTORY_RETENTION_DAYS)
+    if deleted: logger.info("Historique : %d ancienne(s) entrée(s) supprimée(s).", deleted)
+
+def schedule_giveaway_jobs(job_queue, giveaway_key: str):
+    """Planifie le tirage d'un giveaway à partir de son heure de fin et l'inscrit auprès du ticker."""
+    giveaway = active_giveaways[giveaway_key]
+    remaining = giveaway['end_time'] - datetime.datetime.now(giveaway['end_time'].tzinfo)
+    giveaway['draw_job'] = job_queue.run_once(draw_winners_callback, when=max(remaining, datetime.timedelta(0)), data={"giveaway_key": giveaway_key}, name=f"gw_draw_{giveaway_key}")
+    if remaining.total_seconds() > 0: countdown_ticker.register(giveaway_key)
+
+async def restore_giveaways(job_queue) -> int:
+    """Recharge les giveaways actifs après un redémarrage et replanifie leurs jobs.
+
+    Ceux dont la fin est passée pendant l'interruption sont tirés immédiatement.
+    """
+    restored = await giveaway_store.run(giveaway_store.load_all)
+    active_giveaways.update(restored)
+    for giveaway_key in restored: schedule_giveaway_jobs(job_queue, giveaway_key)
+    return len(restored)
 
 # --- Commandes du Bot ---
+@instrumented
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = "💡 *Voici la liste des commandes disponibles* 💡\n\n\\-\\-\\-\n\n*Commandes pour les Administrateurs*\n\n`/giveaway <gagnants> <durée> [@rôle] <prix>`\n_Lance un nouveau giveaway\\. Le rôle est optionnel\\._\n*Exemple:* `/giveaway 2 1h Super Lot`\n*Exemple avec rôle:* `/giveaway 1 30m @vip Lot VIP`\n\n`/annuler_giveaway`\n_Annule le concours en cours dans le chat et le sujet actuels\\._\n\n`/reroll`\n_\\(En réponse à un message de gagnants\\) Retire un nouveau gagnant\\._\n\n`/assigner_role <rôle>`\n_\\(En réponse à un message\\) Assigne un rôle à un utilisateur\\._\n\n`/retirer_role <rôle>`\n_\\(En réponse à un message\\) Retire un rôle à un utilisateur\\._\n\n`/help`\n_Affiche ce message d'aide\\._\n\n*Commandes pour tous*\n\n`/mes_roles`\n_Vérifie les rôles que vous possédez\\._"
+    help_text = "💡 *Voici la liste des commandes disponibles* 💡\n\n\\-\\-\\-\n\n*Commandes pour les Administrateurs*\n\n`/giveaway <gagnants> <durée> [@rôle] <prix>`\n_Lance un nouveau giveaway\\. Le rôle est optionnel\\._\n*Exemple:* `/giveaway 2 1h Super Lot`\n*Exemple avec rôle:* `/giveaway 1 30m @vip Lot VIP`\n\n`/annuler_giveaway [id]`\n_Annule le concours en cours dans le chat et le sujet actuels \\(l'ID est requis s'il y en a plusieurs\\)\\._\n\n`/giveaways`\n_Liste les concours en cours dans le sujet actuel avec leur ID\\._\n\n`/reroll`\n_\\(En réponse à un message de gagnants\\) Retire un nouveau gagnant\\._\n\n`/assigner_role <rôle>`\n_\\(En réponse à un message\\) Assigne un rôle à un utilisateur\\._\n\n`/retirer_role <rôle>`\n_\\(En réponse à un message\\) Retire un rôle à un utilisateur\\._\n\n`/help`\n_Affiche ce message d'aide\\._\n\n*Commandes pour tous*\n\n`/mes_roles`\n_Vérifie les rôles que vous possédez\\._\n\n`/verifier_tirage`\n_\\(En réponse à un message de gagnants\\) Rejoue le tirage à partir de sa graine\\._"
     await update.message.reply_text(text=help_text, parse_mode=constants.ParseMode.MARKDOWN_V2)
 
 # NOUVELLE FONCTION POUR LA COMMANDE /mes_roles
+@instrumented
 async def check_my_roles_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Permet à un utilisateur de vérifier les rôles qu'il possède."""
     user = update.effective_user
     user_id = user.id
     
-    roles_data = load_roles()
-    user_roles = []
-    
-    # On parcourt tous les rôles pour voir où l'utilisateur se trouve
-    for role_name, member_ids in roles_data.items():
-        if user_id in member_ids:
-            user_roles.append(role_name)
+    # Lookup direct dans l'index utilisateur -> rôles
+    user_roles = role_store.roles_of(user_id)
             
     if user_roles:
         # On formate la liste des rôles pour un affichage propre
@@ -188,76 +1477,104 @@ async def check_my_roles_command(update: Update, context: ContextTypes.DEFAULT_T
         
     await update.message.reply_text(text=reply_text, parse_mode=constants.ParseMode.MARKDOWN_V2)
 
+@instrumented
 async def reroll_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (inchangée) ...
+    """[ADMIN] Tire un gagnant supplémentaire (en réponse au message des gagnants), de façon rejouable."""
     if update.effective_user.id not in ADMIN_USER_IDS: return await update.message.reply_text("Désolé, seul un administrateur peut faire un reroll.")
     if not update.message.reply_to_message: return await update.message.reply_text("Usage : Répondez au message d'annonce des gagnants avec `/reroll`.")
-    reroll_message_id = str(update.message.reply_to_message.message_id)
-    history = load_history()
-    if reroll_message_id not in history: return await update.message.reply_text("Je ne trouve pas ce giveaway dans mon historique.")
-    giveaway_data = history[reroll_message_id]
-    all_participants, previous_winners = giveaway_data['participants'], giveaway_data['winner_ids']
-    eligible_participants = {uid_str: uname for uid_str, uname in all_participants.items() if int(uid_str) not in previous_winners}
-    if not eligible_participants: return await update.message.reply_text("Il n'y a plus aucun participant éligible à tirer au sort.")
-    new_winner_id_str = random.choice(list(eligible_participants.keys()))
-    new_winner_id, new_winner_name = int(new_winner_id_str), eligible_participants[new_winner_id_str]
-    giveaway_data['winner_ids'].append(new_winner_id)
-    save_history(history)
+    reroll_chat_id, reroll_message_id = update.message.chat_id, update.message.reply_to_message.message_id
+    result = await history_store.run(history_store.reroll, reroll_chat_id, reroll_message_id)
+    if result is None: return await update.message.reply_text("Je ne trouve pas ce giveaway dans mon historique.")
+    giveaway_data, new_winner_id = result
+    if new_winner_id is None: return await update.message.reply_text("Il n'y a plus aucun participant éligible à tirer au sort.")
+    metrics.inc("rerolls_total")
+    new_winner_name = (await name_store.run(name_store.get, [new_winner_id])).get(new_winner_id, str(new_winner_id))
     winner_mention = f"[{escape_markdown_v2(new_winner_name)}](tg://user?id={new_winner_id})"
     reroll_message = f"📢 *Reroll \\!* 📢\n\nUn nouveau gagnant a été tiré pour le concours *{giveaway_data['prize']}*\\.\n\nFélicitations à notre nouvel élu : {winner_mention} 🎉"
     await update.message.reply_text(reroll_message, parse_mode=constants.ParseMode.MARKDOWN_V2)
 
+@instrumented
+async def verify_draw_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Rejoue un tirage (en réponse au message des gagnants) et vérifie qu'il donne les mêmes gagnants."""
+    if not update.message.reply_to_message: return await update.message.reply_text("Usage : Répondez au message d'annonce des gagnants avec `/verifier_tirage`.")
+    giveaway_data = await history_store.run(history_store.get, update.message.chat_id, update.message.reply_to_message.message_id)
+    if giveaway_data is None: return await update.message.reply_text("Je ne trouve pas ce giveaway dans mon historique.")
+    replayed = replay_draw(giveaway_data)
+    if replayed is None: return await update.message.reply_text("Ce tirage date d'avant les tirages vérifiables et ne peut pas être rejoué.")
+    if replayed == giveaway_data['winner_ids']:
+        await update.message.reply_text(f"✅ Tirage vérifié : la graine {giveaway_data['seed']} redonne exactement les mêmes gagnants ({len(replayed)}).")
+    else: await update.message.reply_text(f"❌ Le tirage rejoué avec la graine {giveaway_data['seed']} ne correspond pas aux gagnants enregistrés.")
+
+@instrumented
 async def assign_role_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (inchangée) ...
+    """[ADMIN] Assigne un rôle à l'auteur du message auquel on répond."""
     if update.effective_user.id not in ADMIN_USER_IDS: return await update.message.reply_text("Désolé, seul un administrateur peut assigner un rôle.")
     if not update.message.reply_to_message: return await update.message.reply_text("Usage : Répondez au message d'un utilisateur avec `/assigner_role <nom_du_role>`")
     try: role_name, target_user_id, target_user_name = context.args[0].lower(), update.message.reply_to_message.from_user.id, update.message.reply_to_message.from_user.full_name
     except IndexError: return await update.message.reply_text("Format incorrect. N'oubliez pas le nom du rôle.")
-    roles = load_roles()
-    if role_name not in roles: roles[role_name] = []
-    if target_user_id not in roles[role_name]:
-        roles[role_name].append(target_user_id)
-        save_roles(roles)
+    if role_store.assign(role_name, target_user_id):
         await update.message.reply_text(f"Le rôle '{role_name}' a bien été assigné à {target_user_name}.")
     else: await update.message.reply_text(f"{target_user_name} a déjà le rôle '{role_name}'.")
 
+@instrumented
 async def remove_role_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (inchangée) ...
+    """[ADMIN] Retire un rôle à l'auteur du message auquel on répond."""
     if update.effective_user.id not in ADMIN_USER_IDS: return await update.message.reply_text("Désolé, seul un administrateur peut retirer un rôle.")
     if not update.message or not update.message.reply_to_message: return await update.message.reply_text("Usage : Répondez au message d'un utilisateur avec `/retirer_role <nom_du_role>`")
     try: role_name, target_user_id, target_user_name = context.args[0].lower(), update.message.reply_to_message.from_user.id, update.message.reply_to_message.from_user.full_name
     except IndexError: return await update.message.reply_text("Format incorrect. Usage: `/retirer_role <nom_du_role>`")
-    roles = load_roles()
-    if role_name in roles and target_user_id in roles[role_name]:
-        roles[role_name].remove(target_user_id)
-        if not roles[role_name]: del roles[role_name]
-        save_roles(roles)
+    if role_store.remove(role_name, target_user_id):
         await update.message.reply_text(f"Le rôle '{role_name}' a été retiré à {target_user_name}.")
     else: await update.message.reply_text(f"{target_user_name} n'a pas (ou plus) le rôle '{role_name}'.")
 
+def describe_giveaways(giveaway_keys: list[str]) -> str:
+    """Liste MarkdownV2 des giveaways (ID, prix, fin) pour les commandes d'administration."""
+    lines = []
+    for giveaway_key in giveaway_keys:
+        giveaway = active_giveaways[giveaway_key]
+        end_time_str = escape_markdown_v2(giveaway['end_time'].strftime("%d %b %Y à %H:%M"))
+        lines.append(f"• `{giveaway_key}` — *{giveaway['prize']}* \\(fin le {end_time_str}\\)")
+    return "\n".join(lines)
+
+@instrumented
+async def list_giveaways_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """[ADMIN] Liste les giveaways en cours dans le chat et le sujet actuels."""
+    if update.effective_user.id not in ADMIN_USER_IDS: return
+    giveaway_keys = active_giveaways.in_topic(update.message.chat_id, update.message.message_thread_id)
+    if not giveaway_keys: return await update.message.reply_text("Il n'y a aucun giveaway en cours dans ce sujet.")
+    await update.message.reply_text("*Giveaways en cours :*\n\n" + describe_giveaways(giveaway_keys), parse_mode=constants.ParseMode.MARKDOWN_V2)
+
+@instrumented
 async def cancel_giveaway_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (inchangée) ...
-    chat_id, message_thread_id = update.message.chat_id, update.message.message_thread_id
-    giveaway_key = f"{chat_id}_{message_thread_id}" if message_thread_id else str(chat_id)
+    """Annule le giveaway dont l'ID est donné, ou le seul giveaway en cours dans le sujet."""
     if update.effective_user.id not in ADMIN_USER_IDS: return await update.message.reply_text("Désolé, seul un administrateur peut annuler un giveaway.")
-    if giveaway_key not in active_giveaways: return await update.message.reply_text("Il n'y a aucun giveaway en cours à annuler dans ce sujet.")
-    for job_name in [f"gw_draw_{giveaway_key}", f"gw_update_slow_{giveaway_key}", f"gw_update_fast_{giveaway_key}", f"gw_final_minute_{giveaway_key}"]:
-        for job in context.job_queue.get_jobs_by_name(job_name): job.schedule_removal()
+    topic_keys = active_giveaways.in_topic(update.message.chat_id, update.message.message_thread_id)
+    if context.args: giveaway_key = context.args[0]
+    elif len(topic_keys) == 1: giveaway_key = topic_keys[0]
+    elif not topic_keys: return await update.message.reply_text("Il n'y a aucun giveaway en cours à annuler dans ce sujet.")
+    else:
+        return await update.message.reply_text(
+            "Plusieurs giveaways sont en cours dans ce sujet, précisez lequel avec `/annuler_giveaway <id>` :\n\n" + describe_giveaways(topic_keys),
+            parse_mode=constants.ParseMode.MARKDOWN_V2)
+    if giveaway_key not in active_giveaways: await state_backend.load_giveaway(context.job_queue, giveaway_key)
+    if giveaway_key not in active_giveaways: return await update.message.reply_text(f"Aucun giveaway en cours avec l'ID '{giveaway_key}'.")
     giveaway = active_giveaways[giveaway_key]
-    prize = giveaway['prize']
-    cancelled_text = f"❌ *GIVEAWAY ANNULÉ* ❌\n\nLe concours pour *{prize}* a été annulé par un administrateur\\."
-    try:
-        await context.bot.edit_message_text(chat_id=chat_id, message_id=giveaway['message_id'], text=cancelled_text, parse_mode=constants.ParseMode.MARKDOWN_V2, reply_markup=None)
-    except Exception as e: print(f"Erreur en éditant le message d'annulation: {e}")
-    if giveaway_key in active_giveaways: del active_giveaways[giveaway_key]
+    if giveaway.get('closed') or not await state_backend.request_cancel(giveaway_key):
+        return await update.message.reply_text("Le tirage de ce giveaway a déjà commencé, il ne peut plus être annulé.")
+    prize, chat_id, message_id = giveaway['prize'], giveaway['chat_id'], giveaway['message_id']
+    drop_local_giveaway(giveaway_key)
+    # Avec plusieurs workers, le message est édité par le détenteur du bail du compte à rebours (shared_state_job)
+    if not state_backend.shared:
+        await show_cancelled(context.bot, chat_id, message_id, prize)
+        await giveaway_store.run(giveaway_store.delete_giveaway, giveaway_key)
     await update.message.reply_text("Le giveaway a bien été annulé.")
 
+@instrumented
 async def giveaway_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (inchangée) ...
+    """[ADMIN] Lance un giveaway : /giveaway <gagnants> <durée> [@rôle] <prix>."""
     if update.effective_user.id not in ADMIN_USER_IDS: return await update.message.reply_text("Désolé, seul un administrateur peut lancer un giveaway.")
     chat_id, message_thread_id = update.message.chat_id, update.message.message_thread_id
-    giveaway_key = f"{chat_id}_{message_thread_id}" if message_thread_id else str(chat_id)
-    if giveaway_key in active_giveaways: return await update.message.reply_text("Un giveaway est déjà en cours dans ce sujet !")
+    giveaway_key = active_giveaways.new_id()
     args = context.args
     if len(args) < 3: return await update.message.reply_text("Format incorrect...")
     try:
@@ -265,7 +1582,7 @@ async def giveaway_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         required_role, prize_start_index = None, 2
         if len(args) > 3 and args[2].startswith('@'):
             potential_role = args[2][1:].lower()
-            if potential_role in load_roles():
+            if role_store.role_exists(potential_role):
                 required_role, prize_start_index = potential_role, 3
         if len(args) <= prize_start_index: raise ValueError("Le nom du prix est manquant.")
         prize = ' '.join(args[prize_start_index:])
@@ -274,36 +1591,31 @@ async def giveaway_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         error_message = str(e) if str(e) else "Format invalide. Vérifiez les nombres et la durée (ex: 10m, 2h, 1d)."
         return await update.message.reply_text(error_message)
     end_time = datetime.datetime.now(datetime.timezone.utc) + duration
-    giveaway_data = { "prize": escape_markdown_v2(prize), "required_role": required_role, "end_time": end_time, "host_mention": update.effective_user.mention_markdown_v2(), "winners_count": winners_count, "participants": {}, "message_id": None, "chat_id": chat_id, "message_thread_id": message_thread_id }
+    giveaway_data = { "prize": escape_markdown_v2(prize), "required_role": required_role, "end_time": end_time, "host_mention": update.effective_user.mention_markdown_v2(), "winners_count": winners_count, "participants": ParticipantSet(), "message_id": None, "chat_id": chat_id, "message_thread_id": message_thread_id }
     active_giveaways[giveaway_key] = giveaway_data
-    message_text = format_giveaway_message(giveaway_key)
-    keyboard = [[InlineKeyboardButton("🎉 Participer", callback_data=f'participate_{giveaway_key}')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    message_text, reply_markup = format_giveaway_message(giveaway_key), giveaway_keyboard(giveaway_key)
     try:
         sent_message = await context.bot.send_message(chat_id, text=message_text, reply_markup=reply_markup, parse_mode=constants.ParseMode.MARKDOWN_V2, message_thread_id=message_thread_id)
         giveaway_data['message_id'] = sent_message.message_id
         image_url = "https://imgur.com/a/fGbNYQ2"
-        caption_text = f"Giveaway pour '{prize}' lancé ! Tirage dans {args[1]}."
+        caption_text = f"Giveaway pour '{prize}' lancé ! Tirage dans {args[1]}. (ID : {giveaway_key})"
+        await giveaway_store.run(giveaway_store.save_giveaway, giveaway_key, giveaway_data)
         await context.bot.send_photo(chat_id=chat_id, photo=image_url, caption=caption_text, message_thread_id=message_thread_id)
-        job_data = {"giveaway_key": giveaway_key}
-        context.job_queue.run_once(draw_winners_callback, when=end_time, data=job_data, name=f"gw_draw_{giveaway_key}")
-        if duration.total_seconds() > 65:
-            context.job_queue.run_repeating(update_countdown_job, interval=60, first=60, data=job_data, name=f"gw_update_slow_{giveaway_key}")
-            transition_time = end_time - datetime.timedelta(seconds=60)
-            context.job_queue.run_once(final_minute_trigger_job, when=transition_time, data=job_data, name=f"gw_final_minute_{giveaway_key}")
-        else:
-            context.job_queue.run_repeating(update_countdown_job, interval=3, data=job_data, name=f"gw_update_fast_{giveaway_key}")
+        schedule_giveaway_jobs(context.job_queue, giveaway_key)
     except Exception as e:
-        print(f"ERREUR CRITIQUE LORS DE L'ENVOI DU MESSAGE DE GIVEAWAY : {e}")
+        count_telegram_error(e)
+        logger.exception("Erreur critique lors de l'envoi du message de giveaway")
         await update.message.reply_text("Une erreur est survenue lors de la création de l'annonce.")
         if giveaway_key in active_giveaways: del active_giveaways[giveaway_key]
+        await giveaway_store.run(giveaway_store.delete_giveaway, giveaway_key)
 
+@instrumented
 async def see_roles_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """[ADMIN] Affiche le contenu du fichier roles.json pour débogage."""
     if update.effective_user.id not in ADMIN_USER_IDS:
         return # Commande invisible pour les non-admins
 
-    roles = load_roles()
+    roles = role_store.as_dict()
     if not roles:
         await update.message.reply_text("Le fichier `roles.json` est vide ou n'existe pas.")
     else:
@@ -318,100 +1630,195 @@ async def see_roles_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=constants.ParseMode.MARKDOWN
             )
 
+@instrumented
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """[ADMIN] Affiche les compteurs et latences (p50/p99) du bot."""
+    if update.effective_user.id not in ADMIN_USER_IDS: return
+    snapshot = metrics.snapshot()
+    lines = [f"{name} : {value}" for name, value in sorted(snapshot["counters"].items())]
+    lines += [f"{name} : n={h['count']} p50≤{h['p50']}s p99≤{h['p99']}s" for name, h in sorted(snapshot["latency_seconds"].items())]
+    await update.message.reply_text("Métriques\n\n" + ("\n".join(lines) or "Aucune donnée pour le moment."))
+
+@instrumented
 async def participate_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Gère le clic sur le bouton de participation et vérifie le rôle (AVEC LOGS DE DÉBOGAGE)."""
+    """Chemin rapide du clic de participation : validation, inscription et réponse immédiate.
+
+    Avec un seul worker, l'inscription est mise en tampon et appliquée par lots par participation_pipeline ;
+    avec l'état partagé, elle est écrite (par lots aussi) dans la base commune avant de répondre.
+    """
     query = update.callback_query
     user = query.from_user
-    chat_id = query.message.chat_id
-    
-    # On récupère la clé du giveaway à partir des données du bouton
-    giveaway_key = query.data.replace('participate_', '')
+    giveaway_key = query.data[len('participate_'):]
 
-    print(f"\n--- NOUVELLE TENTATIVE DE PARTICIPATION ---")
-    print(f"Utilisateur : {user.full_name} (ID: {user.id})")
-    print(f"Giveaway Clé : {giveaway_key}")
+    # Clics répétés ou trop rapprochés : réponse depuis la mémoire, sans rôle, rendu ni écriture
+    if not click_guard.allow(user.id):
+        metrics.inc("clicks_short_circuited_total", reason="rate_limited")
+        return await query.answer("Doucement ! Réessayez dans quelques secondes.")
+    if click_guard.has_joined(user.id, giveaway_key) and giveaway_key in active_giveaways:
+        metrics.inc("clicks_short_circuited_total", reason="duplicate")
+        return await query.answer("Vous participez déjà !", show_alert=True)
 
-    if giveaway_key not in active_giveaways:
-        print("Diagnostic : Giveaway non trouvé dans active_giveaways. Il est probablement terminé.")
-        await query.answer("Désolé, ce giveaway est déjà terminé.", show_alert=True)
-        return
+    logger.debug("Clic de participation : utilisateur %s, giveaway %s", user.id, giveaway_key)
 
-    giveaway = active_giveaways[giveaway_key]
+    giveaway = active_giveaways.get(giveaway_key)
+    # Avec plusieurs workers, le giveaway a pu être créé ailleurs depuis la dernière synchronisation
+    if giveaway is None and state_backend.shared: giveaway = await state_backend.load_giveaway(context.job_queue, giveaway_key)
+    # Un giveaway en cours de tirage n'accepte plus d'inscriptions
+    if giveaway is None or giveaway.get('closed'):
+        metrics.inc("clicks_total", result="ended")
+        return await query.answer("Désolé, ce giveaway est déjà terminé.", show_alert=True)
+
+    # Les admins ont un passe-droit sur le rôle requis
     required_role = giveaway.get("required_role")
-    
-    print(f"Rôle requis pour ce giveaway : {required_role}")
+    if required_role and user.id not in ADMIN_USER_IDS and not role_store.has_role(user.id, required_role):
+        metrics.inc("clicks_total", result="refused_role")
+        return await query.answer(f"Désolé, ce giveaway est réservé aux membres ayant le rôle '{required_role}'.", show_alert=True)
 
-    # --- VÉRIFICATION DU RÔLE (AVEC LOGS) ---
-    if required_role:
-        print("Un rôle est requis. Début de la vérification...")
-        is_admin = user.id in ADMIN_USER_IDS
-        print(f"L'utilisateur est-il admin ? {is_admin}")
+    accepted = await state_backend.add_participant(context.bot, giveaway_key, user.id, user.full_name)
+    if accepted is None:
+        metrics.inc("clicks_total", result="ended")
+        return await query.answer("Désolé, ce giveaway est déjà terminé.", show_alert=True)
+    click_guard.remember(user.id, giveaway_key)
+    if not accepted:
+        metrics.inc("clicks_total", result="duplicate")
+        return await query.answer("Vous participez déjà !", show_alert=True)
+    metrics.inc("clicks_total", result="accepted")
+    await query.answer("Participation enregistrée. Bonne chance !", show_alert=True)
 
-        if is_admin:
-            print("L'utilisateur est admin, il a un passe-droit. Participation autorisée.")
-        else:
-            print("L'utilisateur n'est pas admin. Vérification du rôle nécessaire.")
-            roles = load_roles()
-            print(f"Rôles chargés depuis roles.json : {roles}")
-            
-            user_has_role = False
-            if required_role in roles and user.id in roles[required_role]:
-                user_has_role = True
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Journalise et compte les erreurs non rattrapées des handlers."""
+    if isinstance(context.error, telegram.error.TelegramError): count_telegram_error(context.error)
+    logger.error("Erreur non gérée pendant le traitement d'une mise à jour", exc_info=context.error)
 
-            print(f"L'utilisateur a-t-il le rôle '{required_role}' ? {user_has_role}")
-            
-            if not user_has_role:
-                print(">>> REFUSÉ : L'utilisateur n'a pas le rôle requis.")
-                await query.answer(f"Désolé, ce giveaway est réservé aux membres ayant le rôle '{required_role}'.", show_alert=True)
-                return
-            else:
-                print("L'utilisateur a le rôle requis. Participation autorisée.")
+def write_metrics_snapshot(path: str, snapshot: dict):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f: json.dump(snapshot, f, indent=2)
+    os.replace(tmp_path, path)
 
-    else:
-        print("Aucun rôle n'est requis pour ce giveaway.")
+async def metrics_snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    snapshot = metrics.snapshot()
+    snapshot["time"] = time.time()
+    future = io_executor(METRICS_SNAPSHOT_FILE).submit(write_metrics_snapshot, METRICS_SNAPSHOT_FILE, snapshot)
+    future.add_done_callback(report_io_error)
 
-    # --- FIN DE LA VÉRIFICATION ---
+async def on_startup(application):
+    """Restaure les giveaways en cours et démarre les tâches de fond du bot."""
+    migrated = await history_store.run(history_store.migrate_from_json, HISTORY_FILE)
+    if migrated: logger.info("%d entrée(s) importée(s) depuis %s.", migrated, HISTORY_FILE)
+    application.job_queue.run_repeating(countdown_tick_job, interval=COUNTDOWN_TICK, name="countdown_ticker")
+    if HISTORY_RETENTION_DAYS > 0: application.job_queue.run_repeating(compact_history_job, interval=86400, first=60, name="history_compaction")
+    await state_backend.start()
+    restored = await restore_giveaways(application.job_queue)
+    if restored: logger.info("%d giveaway(s) en cours restauré(s).", restored)
+    if state_backend.shared:
+        application.job_queue.run_repeating(shared_state_job, interval=SHARED_SYNC_INTERVAL, first=0, name="shared_state")
+        logger.info("État partagé via %s (worker %s).", GIVEAWAYS_DB, WORKER_ID)
+    participation_pipeline.start(application.bot)
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await serve_metrics(METRICS_PORT)
+        logger.info("Métriques exposées sur http://127.0.0.1:%d/metrics", METRICS_PORT)
+    if METRICS_SNAPSHOT_FILE:
+        application.job_queue.run_repeating(metrics_snapshot_job, interval=METRICS_SNAPSHOT_INTERVAL, name="metrics_snapshot")
 
-    if str(user.id) in giveaway['participants']:
-        print(">>> REFUSÉ : L'utilisateur participe déjà.")
-        await query.answer("Vous participez déjà !", show_alert=True)
-    else:
-        print(">>> ACCEPTÉ : Ajout de l'utilisateur aux participants.")
-        giveaway['participants'][str(user.id)] = user.full_name
-        await query.answer("Participation enregistrée. Bonne chance !", show_alert=True)
-        
-        # Le reste de la fonction pour mettre à jour le message ne change pas...
-        new_text = format_giveaway_message(giveaway_key)
-        keyboard = [[InlineKeyboardButton("🎉 Participer", callback_data=query.data)]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+async def on_shutdown(application):
+    """Vide les écritures différées avant l'arrêt du bot."""
+    if 'metrics_server' in application.bot_data: application.bot_data['metrics_server'].close()
+    await participation_pipeline.stop()
+    close_stores()
+
+async def run_webhook(application):
+    """Reçoit les mises à jour via un serveur aiohttp local qui alimente la file bornée de l'application.
+
+    Quand la file est pleine, on répond 503 : Telegram renverra la mise à jour plus tard au lieu
+    de nous laisser accumuler du retard en mémoire.
+    """
+    from aiohttp import web
+
+    async def receive_update(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            metrics.inc("webhook_requests_total", result="forbidden")
+            return web.Response(status=403)
         try:
-            await query.edit_message_text(text=new_text, reply_markup=reply_markup, parse_mode=constants.ParseMode.MARKDOWN_V2)
-        except Exception as e:
-            if "Message is not modified" not in str(e): print(f"Ne peut pas éditer le message : {e}")
+            payload = await request.json()
+            if not isinstance(payload, dict): raise ValueError("le corps doit être un objet JSON")
+            update = Update.de_json(payload, application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            metrics.inc("webhook_requests_total", result="invalid")
+            logger.debug("Mise à jour webhook rejetée : %s", e)
+            return web.Response(status=400)
+        try: application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            metrics.inc("webhook_requests_total", result="queue_full")
+            return web.Response(status=503)
+        metrics.inc("webhook_requests_total", result="accepted")
+        return web.Response()
+
+    server = web.Application()
+    server.router.add_post(f"/{WEBHOOK_PATH.lstrip('/')}", receive_update)
+    server.router.add_get("/healthz", lambda request: web.Response(text="ok"))
+    runner = web.AppRunner(server, access_log=None)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(stop_signal, stop_event.set)
+
+    async with application:
+        await on_startup(application)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None, max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES)
+        await application.start()
+        await runner.setup()
+        # Plusieurs workers d'une même machine peuvent écouter sur le même port (état partagé)
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT, reuse_port=state_backend.shared or None).start()
+        logger.info("Webhook en écoute sur http://%s:%d/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH.lstrip('/'))
+        try: await stop_event.wait()
+        finally:
+            await runner.cleanup()
+            await application.stop()
+            await on_shutdown(application)
+
+def build_application():
+    """Application commune aux deux modes : mises à jour traitées en parallèle, file d'attente bornée."""
+    return (ApplicationBuilder().token(TOKEN)
+            .concurrent_updates(CONCURRENT_UPDATES)
+            .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+            .post_init(on_startup).post_shutdown(on_shutdown)
+            .build())
 
 def main():
     """Lance le bot."""
+    log_listener = setup_logging()
     if not TOKEN:
-        print("Erreur: Le token n'a pas été trouvé.")
-        return
-    application = ApplicationBuilder().token(TOKEN).build()
+        logger.error("Le token n'a pas été trouvé.")
+        return log_listener.stop()
+    open_stores()
+    application = build_application()
     # Ajout de toutes les commandes
     application.add_handler(CommandHandler("start", help_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("reroll", reroll_command))
+    application.add_handler(CommandHandler("verifier_tirage", verify_draw_command))
     application.add_handler(CommandHandler("giveaway", giveaway_command))
     application.add_handler(CommandHandler("annuler_giveaway", cancel_giveaway_command))
+    application.add_handler(CommandHandler("giveaways", list_giveaways_command))
     application.add_handler(CommandHandler("assigner_role", assign_role_command))
     application.add_handler(CommandHandler("retirer_role", remove_role_command))
     application.add_handler(CommandHandler("voir_roles", see_roles_command))
+    application.add_handler(CommandHandler("stats", stats_command))
 
     
     # NOUVEAU HANDLER POUR LA COMMANDE /mes_roles
     application.add_handler(CommandHandler("mes_roles", check_my_roles_command))
     
     application.add_handler(CallbackQueryHandler(participate_button, pattern=r'^participate_'))
-    print("Le bot de giveaway (V13 - Vérif Rôles) est démarré...")
-    application.run_polling()
+    application.add_error_handler(error_handler)
+    logger.info("Le bot de giveaway est démarré (mode %s)...", BOT_MODE)
+    if state_backend.shared and BOT_MODE != 'webhook':
+        logger.warning("Telegram n'accepte qu'un seul client en polling : lancez plusieurs workers en mode webhook.")
+    try:
+        if BOT_MODE == 'webhook': asyncio.run(run_webhook(application))
+        else: application.run_polling()
+    finally: log_listener.stop()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
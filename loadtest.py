@@ -0,0 +1,639 @@
+# --- Banc d'essai local du bot de giveaway (aucun appel réel à Telegram) ---
+"""Bancs d'essai locaux : clics concurrents contre un faux Bot, reprise après redémarrage,
+latence des clics pendant une grosse écriture d'historique, mémoire des participants, tirage au sort, rendu des messages.
+
+Usage :
+    python loadtest.py clicks [--clicks 5000] [--users 5000] [--api-latency 0.05] [--concurrency 64]
+    python loadtest.py recovery [--giveaways 50] [--participants 5000]
+    python loadtest.py io [--clicks 2000] [--history-participants 500000]
+    python loadtest.py memory [--sizes 10000 100000 1000000]
+    python loadtest.py draw [--entrants 1000000] [--winners 10] [--rerolls 10]
+    python loadtest.py render [--renders 100000]
+    python loadtest.py load [--users 20000] [--giveaways 20] [--duration 10] [--api-latency 0.05] [--retry-after-rate 0.02]
+    python loadtest.py workers [--workers 4] [--giveaways 5] [--users 5000]
+    python loadtest.py draw-race [--entrants 240] [--late-clicks 50]
+    python loadtest.py reroll-race [--entrants 240] [--rerolls 20]
+    python loadtest.py handoff [--entrants 240] [--lease-ttl 3]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import re
+import statistics
+import tempfile
+import time
+import tracemalloc
+from array import array
+from types import SimpleNamespace
+
+import telegram
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import giveaway_bot as bot_module
+
+class FakeBot:
+    """Faux Bot : enregistre les appels et simule la latence de l'API Telegram.
+
+    Avec `retry_after_rate`, une fraction des éditions et envois de messages échoue avec RetryAfter
+    (erreur 429), comme quand Telegram limite le débit d'un chat.
+    """
+    def __init__(self, latency: float, retry_after_rate: float = 0.0, retry_after: float = 1.0, seed: int = 0):
+        self.latency, self.retry_after_rate, self.retry_after = latency, retry_after_rate, retry_after
+        self.calls: dict[str, int] = {}
+        self.throttled: dict[str, int] = {}
+        self.edits: list[tuple[float, int, str]] = []
+        self._rng = random.Random(seed)
+        self._message_ids = iter(range(1_000_000, 2**62))
+
+    async def _call(self, method: str, can_throttle: bool = False):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(self.latency)
+        if can_throttle and self.retry_after_rate and self._rng.random() < self.retry_after_rate:
+            self.throttled[method] = self.throttled.get(method, 0) + 1
+            raise telegram.error.RetryAfter(datetime.timedelta(seconds=self.retry_after))
+
+    async def answer_callback_query(self, *args, **kwargs): await self._call("answer_callback_query")
+    async def edit_message_text(self, *args, **kwargs):
+        self.edits.append((time.time(), kwargs.get("message_id"), kwargs.get("text")))
+        await self._call("edit_message_text", can_throttle=True)
+
+    async def send_message(self, *args, **kwargs):
+        await self._call("send_message", can_throttle=True)
+        return SimpleNamespace(message_id=next(self._message_ids))
+
+def make_click(bot: FakeBot, giveaway_key: str, user_id: int):
+    """Construit un faux Update de clic, compatible avec participate_button."""
+    async def answer(text=None, show_alert=False): await bot.answer_callback_query(text=text, show_alert=show_alert)
+    async def edit_message_text(**kwargs): await bot.edit_message_text(**kwargs)
+    query = SimpleNamespace(
+        from_user=SimpleNamespace(id=user_id, full_name=f"Utilisateur {user_id}"),
+        message=SimpleNamespace(chat_id=-1001),
+        data=f"participate_{giveaway_key}",
+        answer=answer,
+        edit_message_text=edit_message_text,
+    )
+    return SimpleNamespace(callback_query=query, effective_user=query.from_user)
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def create_bench_giveaway(giveaway_key: str, chat_id: int = -1001, message_id: int = 1, duration: float = 3600) -> dict:
+    giveaway = {
+        "prize": "Banc d'essai", "required_role": None, "host_mention": "bench", "winners_count": 1,
+        "end_time": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=duration),
+        "participants": bot_module.ParticipantSet(), "message_id": message_id, "chat_id": chat_id, "message_thread_id": None,
+    }
+    bot_module.active_giveaways[giveaway_key] = giveaway
+    return giveaway
+
+async def run_clicks(bot: FakeBot, giveaway_key: str, user_ids) -> tuple[list[float], float]:
+    """Lance tous les clics en parallèle ; retourne les latences par clic et la durée totale."""
+    context = SimpleNamespace(bot=bot, job_queue=None)
+    latencies = []
+
+    async def click(user_id: int):
+        started = time.perf_counter()
+        await bot_module.participate_button(make_click(bot, giveaway_key, user_id), context)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(click(user_id) for user_id in user_ids))
+    return latencies, time.perf_counter() - started
+
+async def legacy_participate(update, context):
+    """Clic d'avant le pipeline (ajout au dict, acquittement, puis rendu et édition du message à chaque clic),
+    sans ses print de débogage, pour comparaison."""
+    query = update.callback_query
+    user = query.from_user
+    giveaway_key = query.data.replace('participate_', '')
+    if giveaway_key not in bot_module.active_giveaways: return await query.answer("Désolé, ce giveaway est déjà terminé.", show_alert=True)
+    giveaway = bot_module.active_giveaways[giveaway_key]
+    if str(user.id) in giveaway['participants']: return await query.answer("Vous participez déjà !", show_alert=True)
+    giveaway['participants'][str(user.id)] = user.full_name
+    await query.answer("Participation enregistrée. Bonne chance !", show_alert=True)
+    new_text, reply_markup = legacy_render(giveaway, giveaway_key)
+    try: await query.edit_message_text(text=new_text, reply_markup=reply_markup, parse_mode=telegram.constants.ParseMode.MARKDOWN_V2)
+    except Exception as e:
+        if "Message is not modified" not in str(e): print(f"Ne peut pas éditer le message : {e}")
+
+async def run_click_wave(bot: FakeBot, handler, giveaway_key: str, user_ids, concurrency: int) -> tuple[list[float], float]:
+    """Tous les clics arrivent en même temps et sont traités `concurrency` à la fois (comme concurrent_updates) ;
+    retourne le délai d'acquittement de chaque clic et le temps écoulé jusqu'au dernier acquittement."""
+    context = SimpleNamespace(bot=bot, job_queue=None)
+    slots, acknowledged = asyncio.Semaphore(concurrency), []
+    started = time.perf_counter()
+
+    async def click(user_id: int):
+        update = make_click(bot, giveaway_key, user_id)
+        answer = update.callback_query.answer
+        async def timed_answer(*args, **kwargs):
+            await answer(*args, **kwargs)
+            acknowledged.append(time.perf_counter() - started)
+        update.callback_query.answer = timed_answer
+        async with slots: await handler(update, context)
+
+    await asyncio.gather(*(click(user_id) for user_id in user_ids))
+    return acknowledged, max(acknowledged)
+
+async def bench_clicks(clicks: int, users: int | None, api_latency: float, concurrency: int):
+    """Compare le clic d'avant (rendu + édition à chaque clic) au chemin rapide avec pipeline, contre la même latence d'API.
+
+    Par défaut chaque clic vient d'un utilisateur différent : les clics répétés sont arrêtés par ClickGuard
+    avant le pipeline, et ne mesureraient pas l'inscription.
+    """
+    users = users or clicks
+    user_ids = [1_000_000 + i % users for i in range(clicks)]
+    print(f"{clicks} clics simultanés de {users} utilisateurs, {concurrency} traités en parallèle, latence API {api_latency * 1000:.0f}ms")
+    legacy_bot, legacy_key = FakeBot(api_latency), "-1001_legacy"
+    create_bench_giveaway(legacy_key)['participants'] = {}
+    bot, giveaway_key = FakeBot(api_latency), "-1001_bench"
+    create_bench_giveaway(giveaway_key)
+    bot_module.participation_pipeline.start(bot)
+    results = {}
+    for label, run_bot, handler, key in [("avant (rendu + édition à chaque clic)", legacy_bot, legacy_participate, legacy_key),
+                                         ("après (pipeline par lots)", bot, bot_module.participate_button, giveaway_key)]:
+        latencies, elapsed = await run_click_wave(run_bot, handler, key, user_ids, concurrency)
+        results[label] = clicks / elapsed
+        print(f"{label:<40} {clicks / elapsed:>7.0f} clics acquittés/s | acquittement p50={percentile(latencies, 50) * 1000:.0f}ms"
+              f" p99={percentile(latencies, 99) * 1000:.0f}ms moyenne={statistics.mean(latencies) * 1000:.0f}ms | appels API {run_bot.calls}")
+    await bot_module.participation_pipeline.stop()
+
+    legacy_rate, rate = results.values()
+    print(f"Gain : x{rate / legacy_rate:.1f} clics acquittés par seconde")
+    print(f"Participants enregistrés : avant {len(bot_module.active_giveaways[legacy_key]['participants'])}, après {len(bot_module.active_giveaways[giveaway_key]['participants'])}")
+    print(f"Métriques (après) : {bot_module.metrics.snapshot()['counters']}")
+
+class FakeJobQueue:
+    """Faux JobQueue : compte les jobs planifiés sans rien exécuter."""
+    def __init__(self): self.jobs = 0
+    def run_once(self, *args, **kwargs): self.jobs += 1
+    def run_repeating(self, *args, **kwargs): self.jobs += 1
+
+def bench_recovery(giveaways: int, participants: int):
+    end_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    for g in range(giveaways):
+        giveaway_key = f"-100{g}"
+        bot_module.giveaway_store.save_giveaway(giveaway_key, {
+            "prize": f"Lot {g}", "required_role": None, "end_time": end_time, "host_mention": "bench", "winners_count": 1,
+            "message_id": g, "chat_id": -100 - g, "message_thread_id": None,
+        })
+        bot_module.giveaway_store.add_participants([(giveaway_key, 1_000_000 + i) for i in range(participants)])
+    bot_module.active_giveaways.clear()
+    job_queue = FakeJobQueue()
+    started = time.perf_counter()
+    restored = asyncio.run(bot_module.restore_giveaways(job_queue))
+    elapsed = time.perf_counter() - started
+    total = sum(len(g['participants']) for g in bot_module.active_giveaways.values())
+    print(f"Reprise : {restored} giveaways, {total} participants, {job_queue.jobs} jobs replanifiés en {elapsed * 1000:.1f}ms")
+
+async def bench_io(clicks: int, history_participants: int):
+    """Compare la latence des clics seuls et pendant l'écriture d'une énorme entrée d'historique."""
+    bot = FakeBot(0)
+    bot_module.participation_pipeline.start(bot)
+    create_bench_giveaway("-1001_idle")
+    idle, _ = await run_clicks(bot, "-1001_idle", range(1, clicks + 1))
+    create_bench_giveaway("-1001_busy")
+    participant_ids = array('q', range(history_participants))
+    history_entry = { "prize": "Gros lot", "participant_ids": participant_ids, "winner_ids": [1], "chat_id": -1001, "message_thread_id": None,
+                      "seed": None, "pool_ids": participant_ids, "sampler": None, "rerolls": 0 }
+    write = asyncio.create_task(bot_module.history_store.run(bot_module.history_store.append, 42, history_entry))
+    await asyncio.sleep(0)
+    busy, _ = await run_clicks(bot, "-1001_busy", range(1, clicks + 1))
+    write_still_running = not write.done()
+    await write
+    await bot_module.participation_pipeline.stop()
+    print(f"Clics sans écriture : p50={percentile(idle, 50) * 1000:.2f}ms p99={percentile(idle, 99) * 1000:.2f}ms")
+    print(f"Clics pendant l'écriture ({history_participants} participants) : p50={percentile(busy, 50) * 1000:.2f}ms p99={percentile(busy, 99) * 1000:.2f}ms")
+    print(f"Écriture encore en cours à la fin des clics : {write_still_running}")
+
+def measure_memory(build) -> tuple[int, float]:
+    """Mémoire allouée (octets) par la structure construite par `build()`, et durée de construction."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    structure = build()
+    elapsed = time.perf_counter() - started
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del structure
+    return size, elapsed
+
+def bench_memory(sizes: list[int]):
+    """Compare l'ancien dict {str(id): nom} au ParticipantSet (identifiants seuls, noms sur disque)."""
+    base_id = 5_000_000_000
+    for size in sizes:
+        dict_size, dict_time = measure_memory(lambda: {str(base_id + i * 7): f"Utilisateur {i}" for i in range(size)})
+        set_size, set_time = measure_memory(lambda: bot_module.ParticipantSet(base_id + i * 7 for i in range(size)))
+        print(f"{size:>9} participants : dict {dict_size / 2**20:8.1f} Mo ({dict_time:.2f}s)"
+              f" | ParticipantSet {set_size / 2**20:7.1f} Mo ({set_time:.2f}s) | {set_size / size:.1f} octets/participant")
+
+def timed(label: str, fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    print(f"  {label:<38} {(time.perf_counter() - started) * 1000:9.1f}ms")
+    return result
+
+def bench_draw(tmp_dir: str, entrants: int, winners: int, rerolls: int):
+    """Tirage parmi `entrants` participants : sans rôle, avec rôle requis, et pondéré (10 % de VIP à 3 tickets)."""
+    participants = bot_module.ParticipantSet(range(1, entrants + 1))
+    roles_path = os.path.join(tmp_dir, "roles.json")
+    with open(roles_path, 'w') as f:
+        json.dump({"membre": list(range(1, entrants + 1, 2)), "vip": list(range(1, entrants + 1, 10))}, f)
+    asyncio.run(bot_module.role_store.reload_if_changed())
+    for label, required_role, role_weights in [("uniforme", None, {}), ("rôle requis", "membre", {}), ("pondéré", None, {"vip": 3})]:
+        print(f"{entrants} participants, tirage {label} :")
+        bot_module.ROLE_WEIGHTS = role_weights
+        pool, sampler = timed("éligibilité + poids", bot_module.build_draw_pool, participants.ids, required_role)
+        seed = 42
+        winner_ids = timed(f"{winners} gagnants", bot_module.pick_winners, pool, sampler, winners, random.Random(seed))
+        started = time.perf_counter()
+        for reroll in range(1, rerolls + 1):
+            winner_ids += bot_module.pick_winners(pool, sampler, 1, random.Random(f"{seed}:{reroll}"), exclude=winner_ids)
+        print(f"  {f'{rerolls} rerolls':<38} {(time.perf_counter() - started) * 1000:9.1f}ms")
+        entry = {"seed": seed, "pool_ids": pool, "sampler": sampler, "rerolls": rerolls, "winner_ids": winner_ids}
+        print(f"  rejeu identique : {timed('rejeu', bot_module.replay_draw, entry) == winner_ids}")
+
+def legacy_render(giveaway: dict, giveaway_key: str):
+    """Rendu d'avant le cache de modèles (reconstruction complète + clavier + regex recompilée), pour comparaison."""
+    escape_chars = r'_*[]()~`>#+-=|{}.!'
+    re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', giveaway['prize'])
+    prize, end_time, host = giveaway['prize'], giveaway['end_time'], giveaway['host_mention']
+    participants_count, winners_count = len(giveaway['participants']), giveaway['winners_count']
+    time_left = end_time - datetime.datetime.now(end_time.tzinfo)
+    days, remainder = divmod(int(time_left.total_seconds()), 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if days > 0: time_left_str = f"dans {days}j {hours}h"
+    elif hours > 0: time_left_str = f"dans {hours}h {minutes}m"
+    elif minutes > 0: time_left_str = f"dans {minutes}m {seconds}s"
+    else: time_left_str = f"dans {seconds}s"
+    end_time_str = end_time.strftime("%d %b %Y à %H:%M")
+    message = ( f"🎉 *{prize}* 🎉\n\n" f"*Se termine :* {time_left_str} \\(le {end_time_str}\\)\n" f"*Organisé par :* {host}\n" f"*Participants :* {participants_count}\n" f"*Gagnants :* {winners_count}" )
+    return message, InlineKeyboardMarkup([[InlineKeyboardButton("🎉 Participer", callback_data=f'participate_{giveaway_key}')]])
+
+def bench_render(renders: int):
+    giveaway_key = "render"
+    giveaway = create_bench_giveaway(giveaway_key)
+    cases = [
+        ("avant (reconstruction complète)", lambda: legacy_render(giveaway, giveaway_key)),
+        ("après, rien n'a changé", lambda: bot_module.render_giveaway_update(giveaway_key)),
+        ("après, un participant de plus à chaque rendu", lambda: (giveaway['participants'].add(len(giveaway['participants']) + 1), bot_module.render_giveaway_update(giveaway_key))),
+    ]
+    for label, render in cases:
+        started = time.perf_counter()
+        for _ in range(renders): render()
+        elapsed = time.perf_counter() - started
+        print(f"{label:<48} {renders / elapsed:>10.0f} rendus/s")
+
+async def bench_load(users: int, giveaways: int, duration: float, clicks_per_user: float, api_latency: float, retry_after_rate: float):
+    """Scénario complet : N utilisateurs cliquent sur M giveaways concurrents pendant `duration` secondes,
+    avec le ticker du compte à rebours et le planificateur d'éditions actifs, puis tous les tirages ont lieu.
+    """
+    bot = FakeBot(api_latency, retry_after_rate)
+    rng = random.Random(1)
+    giveaway_keys = [f"-100{g}_load" for g in range(giveaways)]
+    for g, giveaway_key in enumerate(giveaway_keys):
+        create_bench_giveaway(giveaway_key, chat_id=-100 - g, message_id=g + 1, duration=duration)
+        bot_module.countdown_ticker.register(giveaway_key)
+    # Chaque utilisateur clique `clicks_per_user` fois en moyenne (les doublons font partie du scénario)
+    clicks = [(rng.uniform(0, duration), rng.choice(giveaway_keys), 1_000_000 + rng.randrange(users)) for _ in range(int(users * clicks_per_user))]
+    tick_context = SimpleNamespace(bot=bot, job_queue=None)
+    click_context = SimpleNamespace(bot=bot, job_queue=None)
+    latencies = []
+
+    async def click(at: float, giveaway_key: str, user_id: int):
+        await asyncio.sleep(at)
+        started = time.perf_counter()
+        await bot_module.participate_button(make_click(bot, giveaway_key, user_id), click_context)
+        latencies.append(time.perf_counter() - started)
+
+    async def ticker():
+        while True:
+            await bot_module.countdown_tick_job(tick_context)
+            await asyncio.sleep(bot_module.COUNTDOWN_TICK)
+
+    tracemalloc.start()
+    bot_module.participation_pipeline.start(bot)
+    ticker_task = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(click(*c) for c in clicks))
+    clicks_elapsed = time.perf_counter() - started
+    await asyncio.gather(*(bot_module.draw_winners_callback(SimpleNamespace(bot=bot, job=SimpleNamespace(data={"giveaway_key": k}), job_queue=None)) for k in giveaway_keys))
+    ticker_task.cancel()
+    await bot_module.participation_pipeline.stop()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    snapshot = bot_module.metrics.snapshot()
+    api_calls = sum(bot.calls.values())
+    print(f"{users} utilisateurs, {giveaways} giveaways, {len(clicks)} clics sur {duration:.0f}s (latence API {api_latency * 1000:.0f}ms, 429 sur {retry_after_rate:.0%} des éditions)")
+    print(f"Débit : {len(clicks) / clicks_elapsed:.0f} clics/s, tirages terminés en {time.perf_counter() - started:.1f}s au total")
+    print(f"Latence des clics (mesurée) : p50={percentile(latencies, 50) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms")
+    print("Latence par handler (histogrammes, borne haute du bucket) :")
+    for name, h in sorted(snapshot["latency_seconds"].items()):
+        if name.startswith("handler_latency_seconds"): print(f"  {name:<58} n={h['count']:<7} p50≤{h['p50']}s p99≤{h['p99']}s")
+    print(f"Appels API : {api_calls} ({api_calls / len(clicks):.3f} par clic) {bot.calls}")
+    print(f"Réponses 429 simulées : {bot.throttled}")
+    print(f"Clics : { {k: v for k, v in snapshot['counters'].items() if k.startswith('clicks_total')} }")
+    print(f"Éditions : { {k: v for k, v in snapshot['counters'].items() if k.startswith('message_edits_total')} }")
+    print(f"Pic mémoire (tracemalloc) : {peak_memory / 2**20:.1f} Mo")
+
+async def bench_draw_race(entrants: int, late_clicks: int):
+    """Régression : des clics reçus pendant l'annonce des gagnants ne sont ni acceptés, ni enregistrés dans
+    l'historique, et /verifier_tirage retrouve les gagnants annoncés. Code de sortie 1 en cas d'échec."""
+    bot = FakeBot(0.01)
+    giveaway_key = "-1001_race"
+    giveaway = create_bench_giveaway(giveaway_key)
+    giveaway['winners_count'] = 3
+    for user_id in range(1, entrants + 1): giveaway['participants'].add(user_id)
+    bot_module.participation_pipeline.start(bot)
+    context = SimpleNamespace(bot=bot, job=SimpleNamespace(data={"giveaway_key": giveaway_key}), job_queue=None)
+    send_message, announcements = bot.send_message, []
+
+    async def send_message_with_late_clicks(*args, **kwargs):
+        await asyncio.gather(*(bot_module.participate_button(make_click(bot, giveaway_key, entrants + 1 + i), context) for i in range(late_clicks)))
+        announcement = await send_message(*args, **kwargs)
+        announcements.append(announcement.message_id)
+        return announcement
+
+    bot.send_message = send_message_with_late_clicks
+    await bot_module.draw_winners_callback(context)
+    await bot_module.participation_pipeline.stop()
+    entry = await bot_module.history_store.run(bot_module.history_store.get, -1001, announcements[0])
+    accepted = bot_module.metrics.counter("clicks_total", result="accepted")
+    checks = {
+        "clics tardifs refusés": accepted == 0,
+        f"historique limité aux {entrants} participants du tirage": len(entry['participant_ids']) == entrants,
+        "le tirage rejoué donne les gagnants annoncés": bot_module.replay_draw(entry) == entry['winner_ids'],
+    }
+    for label, ok in checks.items(): print(f"{'OK ' if ok else 'ÉCHEC'} {label}")
+    if not all(checks.values()): raise SystemExit(1)
+
+def make_command(user_id: int, chat_id: int, replies: list[str], reply_to_message_id: int | None = None, args=(), bot=None, job_queue=None):
+    """Construit un faux Update de commande et son contexte ; les réponses du bot sont ajoutées à `replies`."""
+    async def reply_text(text, **kwargs): replies.append(text)
+    message = SimpleNamespace(chat_id=chat_id, message_thread_id=None, reply_text=reply_text,
+                              reply_to_message=SimpleNamespace(message_id=reply_to_message_id) if reply_to_message_id else None)
+    return SimpleNamespace(message=message, effective_user=SimpleNamespace(id=user_id)), SimpleNamespace(bot=bot, args=list(args), job_queue=job_queue)
+
+async def bench_reroll_race(entrants: int, rerolls: int):
+    """Régression : des /reroll simultanés sur la même annonce tirent chacun un gagnant différent, le compteur
+    les compte tous et /verifier_tirage retrouve la liste complète. Code de sortie 1 en cas d'échec."""
+    bot = FakeBot(0.001)
+    giveaway_key = "-1001_reroll"
+    giveaway = create_bench_giveaway(giveaway_key)
+    giveaway['winners_count'] = 3
+    for user_id in range(1, entrants + 1): giveaway['participants'].add(user_id)
+    send_message, announcements = bot.send_message, []
+
+    async def record_announcement(*args, **kwargs):
+        announcement = await send_message(*args, **kwargs)
+        announcements.append(announcement.message_id)
+        return announcement
+
+    bot.send_message = record_announcement
+    await bot_module.draw_winners_callback(SimpleNamespace(bot=bot, job=SimpleNamespace(data={"giveaway_key": giveaway_key}), job_queue=None))
+    initial_winners = (await bot_module.history_store.run(bot_module.history_store.get, -1001, announcements[0]))['winner_ids']
+    replies = []
+    await asyncio.gather(*(bot_module.reroll_command(*make_command(bot_module.ADMIN_USER_IDS[0], -1001, replies, announcements[0])) for _ in range(rerolls)))
+    rerolled = [int(user_id) for reply in replies for user_id in re.findall(r"tg://user\?id=(\d+)", reply)]
+    entry = await bot_module.history_store.run(bot_module.history_store.get, -1001, announcements[0])
+    checks = {
+        f"{rerolls} nouveaux gagnants annoncés, tous différents": len(rerolled) == rerolls and len(set(rerolled)) == rerolls,
+        "aucun gagnant initial tiré à nouveau": not set(rerolled) & set(initial_winners),
+        f"compteur de rerolls à {rerolls}": entry['rerolls'] == rerolls,
+        "historique = gagnants initiaux + gagnants annoncés": entry['winner_ids'][:len(initial_winners)] == initial_winners and sorted(entry['winner_ids'][len(initial_winners):]) == sorted(rerolled),
+        "le tirage rejoué donne les gagnants enregistrés": bot_module.replay_draw(entry) == entry['winner_ids'],
+    }
+    for label, ok in checks.items(): print(f"{'OK ' if ok else 'ÉCHEC'} {label}")
+    if not all(checks.values()): raise SystemExit(1)
+
+def open_bench_stores(tmp_dir: str, shared: bool = False, worker_id: str = "bench"):
+    """Ouvre les stockages du bot dans un dossier jetable, comme un worker lancé avec STATE_BACKEND=sqlite si `shared`."""
+    bot_module.open_stores(os.path.join(tmp_dir, "bench.db"), os.path.join(tmp_dir, "roles.json"), shared, worker_id)
+
+async def run_shared_worker(giveaway_keys: list[str], users: int, start_at: float) -> dict:
+    bot = FakeBot(0.01)
+    job_queue = FakeJobQueue()
+    context = SimpleNamespace(bot=bot, job_queue=job_queue)
+    await bot_module.state_backend.start()
+    await bot_module.restore_giveaways(job_queue)
+    await asyncio.sleep(start_at - time.time())
+    # Tous les workers reçoivent les mêmes clics : chaque inscription arrive en autant d'exemplaires
+    started = time.perf_counter()
+    await asyncio.gather(*(bot_module.participate_button(make_click(bot, giveaway_key, 1_000_000 + u), context)
+                           for u in range(users) for giveaway_key in giveaway_keys))
+    clicks_elapsed = time.perf_counter() - started
+    await bot_module.shared_state_job(context)
+    # Les jobs de tirage de tous les workers se déclenchent en même temps
+    await asyncio.sleep(start_at + 1 + clicks_elapsed * 2 - time.time())
+    await asyncio.gather(*(bot_module.draw_winners_callback(SimpleNamespace(bot=bot, job=SimpleNamespace(data={"giveaway_key": k}), job_queue=job_queue)) for k in giveaway_keys))
+    counters = bot_module.metrics.snapshot()['counters']
+    return {"clicks_per_s": users * len(giveaway_keys) / clicks_elapsed, "announcements": bot.calls.get("send_message", 0),
+            "accepted": counters.get('clicks_total{result="accepted"}', 0), "duplicate": counters.get('clicks_total{result="duplicate"}', 0)}
+
+def shared_worker(tmp_dir: str, worker_id: str, giveaway_keys: list[str], users: int, start_at: float) -> dict:
+    open_bench_stores(tmp_dir, shared=True, worker_id=worker_id)
+    try: return asyncio.run(run_shared_worker(giveaway_keys, users, start_at))
+    finally: bot_module.close_stores()
+
+def bench_workers(tmp_dir: str, workers: int, giveaways: int, users: int):
+    """Plusieurs processus partagent la même base : chaque utilisateur doit être inscrit une seule fois
+    et chaque giveaway tiré une seule fois, quel que soit le nombre de workers."""
+    end_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    giveaway_keys = [f"shared{g}" for g in range(giveaways)]
+    for g, giveaway_key in enumerate(giveaway_keys):
+        bot_module.giveaway_store.save_giveaway(giveaway_key, {
+            "prize": f"Lot {g}", "required_role": None, "end_time": end_time, "host_mention": "bench", "winners_count": 1,
+            "message_id": g + 1, "chat_id": -100 - g, "message_thread_id": None,
+        })
+    start_at = time.time() + 2
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        results = pool.starmap(shared_worker, [(tmp_dir, f"worker-{w}", giveaway_keys, users, start_at) for w in range(workers)])
+    for w, result in enumerate(results):
+        print(f"worker-{w} : {result['clicks_per_s']:.0f} clics/s, {result['accepted']} acceptés, {result['duplicate']} doublons, {result['announcements']} annonce(s)")
+    history = bot_module.history_store.conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+    accepted, announcements = sum(r['accepted'] for r in results), sum(r['announcements'] for r in results)
+    checks = {
+        f"inscriptions acceptées : {accepted} (attendu {users * giveaways})": accepted == users * giveaways,
+        f"annonces de gagnants : {announcements} (attendu {giveaways})": announcements == giveaways,
+        f"entrées d'historique : {history} (attendu {giveaways})": history == giveaways,
+    }
+    for label, ok in checks.items(): print(f"{'OK ' if ok else 'ÉCHEC'} {label}")
+    if not all(checks.values()): raise SystemExit(1)
+
+class LoopJobQueue:
+    """JobQueue minimal qui exécute réellement les jobs `run_once` sur la boucle asyncio du worker."""
+    def __init__(self, bot):
+        self.bot, self._tasks = bot, set()
+
+    def run_once(self, callback, when, data=None, name=None):
+        delay = when.total_seconds() if isinstance(when, datetime.timedelta) else when
+        job = SimpleNamespace(data=data, name=name, removed=False)
+        job.schedule_removal = lambda: setattr(job, "removed", True)
+
+        async def run():
+            await asyncio.sleep(delay)
+            if not job.removed: await callback(SimpleNamespace(bot=self.bot, job=job, job_queue=self))
+
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+async def run_handoff_worker(role: str, giveaway_key: str, start_at: float, duration: float) -> dict:
+    bot = FakeBot(0.01)
+    job_queue = LoopJobQueue(bot)
+    context = SimpleNamespace(bot=bot, job=None, job_queue=job_queue)
+    if role == "crash":
+        # Le worker meurt pendant l'annonce des gagnants : bail de tirage pris, giveaway 'closed', rien d'enregistré
+        async def crash(*args, **kwargs): os._exit(3)
+        bot.send_message = crash
+    # Les autres rôles arrivent une fois le bail du compte à rebours (ou du tirage) pris par le premier worker
+    await asyncio.sleep(start_at + (1 if role in ("cancel", "takeover") else 0) - time.time())
+    await bot_module.state_backend.start()
+    await bot_module.restore_giveaways(job_queue)
+    replies = []
+    while time.time() < start_at + duration:
+        await bot_module.shared_state_job(context)
+        await bot_module.countdown_tick_job(context)
+        if role == "cancel" and not replies:
+            await bot_module.cancel_giveaway_command(*make_command(bot_module.ADMIN_USER_IDS[0], -1001, replies, args=[giveaway_key], bot=bot, job_queue=job_queue))
+        await asyncio.sleep(0.1)
+    return {"edits": bot.edits, "announcements": bot.calls.get("send_message", 0), "replies": replies}
+
+def handoff_worker(tmp_dir: str, role: str, giveaway_key: str, start_at: float, duration: float, lease_ttl: float):
+    # Baux et cadences raccourcis pour que le scénario tienne en quelques secondes
+    bot_module.LEASE_TTL, bot_module.SHARED_SYNC_INTERVAL = lease_ttl, 0.5
+    bot_module.countdown_ticker.intervals = [(0, 0.5)]
+    bot_module.edit_scheduler.chat_min_interval = 0.2
+    open_bench_stores(tmp_dir, shared=True, worker_id=role)
+    try: result = asyncio.run(run_handoff_worker(role, giveaway_key, start_at, duration))
+    finally: bot_module.close_stores()
+    with open(os.path.join(tmp_dir, f"{role}.json"), 'w') as f: json.dump(result, f)
+
+def run_handoff(tmp_dir: str, giveaway_key: str, roles: list[str], duration: float, lease_ttl: float) -> tuple[dict, dict]:
+    """Lance un processus par rôle sur la base partagée ; retourne les codes de sortie et les résultats de chacun."""
+    start_at = time.time() + 2
+    spawn = multiprocessing.get_context("spawn")
+    processes = {role: spawn.Process(target=handoff_worker, args=(tmp_dir, role, giveaway_key, start_at, duration, lease_ttl)) for role in roles}
+    for process in processes.values(): process.start()
+    for process in processes.values(): process.join(duration + 30)
+    results = {}
+    for role in roles:
+        path = os.path.join(tmp_dir, f"{role}.json")
+        if os.path.exists(path):
+            with open(path) as f: results[role] = json.load(f)
+    return {role: process.exitcode for role, process in processes.items()}, results
+
+def bench_handoff(tmp_dir: str, entrants: int, lease_ttl: float):
+    """Régression multi-workers, chaque worker dans son propre processus. Code de sortie 1 en cas d'échec.
+
+    - annulation depuis un worker pendant que le compte à rebours est édité par un autre : le détenteur du bail
+      écrit l'annonce d'annulation après ses propres éditions, puis supprime le giveaway ;
+    - tirage interrompu : le worker qui tire meurt pendant l'annonce, un autre reprend le tirage à l'expiration
+      de son bail et l'enregistre une seule fois.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    bot_module.giveaway_store.save_giveaway("cancel", {
+        "prize": "Lot annulé", "required_role": None, "end_time": now + datetime.timedelta(minutes=5), "host_mention": "bench", "winners_count": 1,
+        "message_id": 1, "chat_id": -1001, "message_thread_id": None,
+    })
+    exit_codes, results = run_handoff(tmp_dir, "cancel", ["countdown", "cancel"], 4, lease_ttl)
+    countdown_edits = results.get("countdown", {}).get("edits", [])
+    cancel_at = min((at for at, _, text in countdown_edits if "ANNULÉ" in text), default=None)
+    remaining = bot_module.giveaway_store.conn.execute("SELECT COUNT(*) FROM giveaways").fetchone()[0]
+    checks = {
+        "annulation : les deux workers terminent": exit_codes == {"countdown": 0, "cancel": 0},
+        "annulation : acceptée par le worker qui la reçoit": results.get("cancel", {}).get("replies") == ["Le giveaway a bien été annulé."],
+        "annulation : compte à rebours édité avant l'annulation": cancel_at is not None and any(at < cancel_at for at, _, text in countdown_edits if "ANNULÉ" not in text),
+        "annulation : annonce écrite en dernier, par le détenteur du bail": bool(countdown_edits) and "ANNULÉ" in countdown_edits[-1][2] and "cancel" in results and not results["cancel"]["edits"],
+        "annulation : giveaway supprimé, aucun tirage": remaining == 0 and not any(r["announcements"] for r in results.values()),
+    }
+
+    bot_module.giveaway_store.save_giveaway("takeover", {
+        "prize": "Lot repris", "required_role": None, "end_time": now, "host_mention": "bench", "winners_count": 2,
+        "message_id": 2, "chat_id": -1002, "message_thread_id": None,
+    })
+    bot_module.giveaway_store.add_participants([("takeover", user_id) for user_id in range(1, entrants + 1)])
+    exit_codes, results = run_handoff(tmp_dir, "takeover", ["crash", "takeover"], lease_ttl + 6, lease_ttl)
+    history = bot_module.history_store.conn.execute("SELECT message_id FROM history WHERE chat_id = -1002").fetchall()
+    entry = bot_module.history_store.get(-1002, history[0][0]) if len(history) == 1 else None
+    remaining = bot_module.giveaway_store.conn.execute("SELECT COUNT(*) FROM giveaways").fetchone()[0]
+    checks.update({
+        "reprise : le premier worker meurt pendant l'annonce": exit_codes.get("crash") == 3,
+        "reprise : le second worker annonce les gagnants une seule fois": exit_codes.get("takeover") == 0 and results.get("takeover", {}).get("announcements") == 1,
+        f"reprise : une seule entrée d'historique, avec les {entrants} participants": entry is not None and len(entry['participant_ids']) == entrants,
+        "reprise : le tirage rejoué donne les gagnants enregistrés": entry is not None and bot_module.replay_draw(entry) == entry['winner_ids'],
+        "reprise : giveaway supprimé": remaining == 0,
+    })
+    for label, ok in checks.items(): print(f"{'OK ' if ok else 'ÉCHEC'} {label}")
+    if not all(checks.values()): raise SystemExit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+    clicks = subparsers.add_parser("clicks", help="clics concurrents sur un giveaway")
+    clicks.add_argument("--clicks", type=int, default=5000)
+    clicks.add_argument("--users", type=int, default=None, help="utilisateurs distincts (défaut : un par clic)")
+    clicks.add_argument("--api-latency", type=float, default=0.05, help="latence simulée de l'API (s)")
+    clicks.add_argument("--concurrency", type=int, default=bot_module.CONCURRENT_UPDATES, help="clics traités en parallèle")
+    recovery = subparsers.add_parser("recovery", help="reprise des giveaways actifs après redémarrage")
+    recovery.add_argument("--giveaways", type=int, default=50)
+    recovery.add_argument("--participants", type=int, default=5000)
+    io = subparsers.add_parser("io", help="latence des clics pendant une écriture d'historique")
+    io.add_argument("--clicks", type=int, default=2000)
+    io.add_argument("--history-participants", type=int, default=500_000)
+    memory = subparsers.add_parser("memory", help="mémoire du stockage des participants")
+    memory.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    draw = subparsers.add_parser("draw", help="tirage au sort et rerolls")
+    draw.add_argument("--entrants", type=int, default=1_000_000)
+    draw.add_argument("--winners", type=int, default=10)
+    draw.add_argument("--rerolls", type=int, default=10)
+    render = subparsers.add_parser("render", help="rendu du message de giveaway")
+    render.add_argument("--renders", type=int, default=100_000)
+    load = subparsers.add_parser("load", help="scénario complet : clics, compte à rebours, éditions et tirages")
+    load.add_argument("--users", type=int, default=20_000)
+    load.add_argument("--giveaways", type=int, default=20)
+    load.add_argument("--duration", type=float, default=10, help="durée des giveaways et de la vague de clics (s)")
+    load.add_argument("--clicks-per-user", type=float, default=1.2)
+    load.add_argument("--api-latency", type=float, default=0.05, help="latence simulée de l'API (s)")
+    load.add_argument("--retry-after-rate", type=float, default=0.02, help="proportion d'éditions refusées avec 429")
+    workers = subparsers.add_parser("workers", help="plusieurs workers sur l'état partagé SQLite")
+    workers.add_argument("--workers", type=int, default=4)
+    workers.add_argument("--giveaways", type=int, default=5)
+    workers.add_argument("--users", type=int, default=5000)
+    draw_race = subparsers.add_parser("draw-race", help="régression : clics reçus pendant l'annonce des gagnants")
+    draw_race.add_argument("--entrants", type=int, default=240)
+    draw_race.add_argument("--late-clicks", type=int, default=50)
+    reroll_race = subparsers.add_parser("reroll-race", help="régression : /reroll simultanés sur la même annonce")
+    reroll_race.add_argument("--entrants", type=int, default=240)
+    reroll_race.add_argument("--rerolls", type=int, default=20)
+    handoff = subparsers.add_parser("handoff", help="régression multi-workers : annulation et reprise d'un tirage interrompu")
+    handoff.add_argument("--entrants", type=int, default=240)
+    handoff.add_argument("--lease-ttl", type=float, default=3.0, help="durée des baux (s) dans les workers du scénario")
+    args = parser.parse_args()
+
+    # Base et rôles jetables : le banc d'essai ne doit jamais toucher aux données du bot
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        open_bench_stores(tmp_dir, shared=args.bench in ("workers", "handoff"))
+        try:
+            if args.bench == "clicks": asyncio.run(bench_clicks(args.clicks, args.users, args.api_latency, args.concurrency))
+            elif args.bench == "recovery": bench_recovery(args.giveaways, args.participants)
+            elif args.bench == "io": asyncio.run(bench_io(args.clicks, args.history_participants))
+            elif args.bench == "memory": bench_memory(args.sizes)
+            elif args.bench == "draw": bench_draw(tmp_dir, args.entrants, args.winners, args.rerolls)
+            elif args.bench == "render": bench_render(args.renders)
+            elif args.bench == "draw-race": asyncio.run(bench_draw_race(args.entrants, args.late_clicks))
+            elif args.bench == "reroll-race": asyncio.run(bench_reroll_race(args.entrants, args.rerolls))
+            elif args.bench == "workers": bench_workers(tmp_dir, args.workers, args.giveaways, args.users)
+            elif args.bench == "handoff": bench_handoff(tmp_dir, args.entrants, args.lease_ttl)
+            else: asyncio.run(bench_load(args.users, args.giveaways, args.duration, args.clicks_per_user, args.api_latency, args.retry_after_rate))
+        finally: bot_module.close_stores()
+
+if __name__ == '__main__':
+    main()